@@ -7,6 +7,7 @@ UNIFINISHED
 import argparse
 import configparser
 import os
+from concurrent.futures import ThreadPoolExecutor
 import pyeo
 
 if __name__ == "__main__":
@@ -36,10 +37,15 @@ if __name__ == "__main__":
 
     api_key = pyeo.queries_and_downloads.load_api_key(api_key_path)
 
-    # Download two images
+    # Download two images. The downloads are independent and spend their time waiting on Planet, so they run side
+    # by side
 
-    pyeo.queries_and_downloads.download_planet_image_on_day(aoi_path, date_1, planet_image_path, api_key)
-    pyeo.queries_and_downloads.download_planet_image_on_day(aoi_path, date_2, planet_image_path, api_key)
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        downloads = [executor.submit(pyeo.queries_and_downloads.download_planet_image_on_day,
+                                     aoi_path, date, planet_image_path, api_key)
+                     for date in (date_1, date_2)]
+        for download in downloads:
+            download.result()
 
     # Save RGB
 
@@ -98,11 +98,9 @@ def rolling_detection(config_path,
 
         if arg_start_date == "LATEST":
             # This isn't nice, but returns the yyyymmdd string of the latest classified image
-            start_date = pyeo.filesystem_utilities.get_image_acquisition_time(
-                pyeo.filesystem_utilities.sort_by_timestamp(
-                    [image_name for image_name in os.listdir(catagorised_image_dir) if image_name.endswith(".tif")],
-                    recent_first=True
-                )[0]).strftime("%Y%m%d")
+            start_date = pyeo.filesystem_utilities.get_image_acquisition_time(os.path.basename(
+                pyeo.filesystem_utilities.get_sorted_image_paths(catagorised_image_dir, suffix=".tif")[0]
+            )).strftime("%Y%m%d")
         elif arg_start_date:
             start_date = arg_start_date
 
@@ -177,13 +175,8 @@ def rolling_detection(config_path,
 
         log.info("Finding most recent composite")
         try:
-            latest_composite_name = \
-                pyeo.filesystem_utilities.sort_by_timestamp(
-
-                    [image_name for image_name in os.listdir(composite_dir) if image_name.endswith(".tif")],
-                    recent_first=True
-                )[0]
-            latest_composite_path = os.path.join(composite_dir, latest_composite_name)
+            latest_composite_path = \
+                pyeo.filesystem_utilities.get_sorted_image_paths(composite_dir, suffix=".tif")[0]
             log.info("Most recent composite at {}".format(latest_composite_path))
         except IndexError:
             log.critical("Latest composite not found. The first time you run this script, you need to include the "
@@ -193,18 +186,15 @@ def rolling_detection(config_path,
             sys.exit(1)
 
         log.info("Sorting image list")
-        images = \
-            pyeo.filesystem_utilities.sort_by_timestamp(
-                [image_name for image_name in os.listdir(merged_image_dir) if image_name.endswith(".tif")],
-                recent_first=False
-            )
+        images = pyeo.filesystem_utilities.get_sorted_image_paths(merged_image_dir, suffix=".tif",
+                                                                  recent_first=False)
         if not images:
             raise FileNotFoundError("No images found in {}. Did your preprocessing complete?".format(merged_image_dir))
         log.info("Images to process: {}".format(images))
 
-        for image in images:
+        for new_image_path in images:
+            image = os.path.basename(new_image_path)
             log.info("Detecting change for {}".format(image))
-            new_image_path = os.path.join(merged_image_dir, image)
 
             # Stack with preceding composite
             if do_stack or do_all:
@@ -44,9 +44,18 @@ def create_display_layer(class_path, out_path, class_color_key):
     display_array = display_raster.GetVirtualMemArray(eAccess=gdal.GF_Write)
 
     class_array = class_raster.GetVirtualMemArray()
-    for index, class_pixel in np.ndenumerate(class_array):
-        display_array[:, index[0], index[1]] =\
-            [class_row[1:4] for class_row in class_color_key if class_row[0] == str(class_pixel)][0]
+    # The key is turned into a [band, class] lookup table once, so each band of the display layer is a single gather
+    # over the class image instead of a search through the key for every pixel. Classes not in the key are black.
+    if class_array.min() < 0:
+        raise ValueError("{} contains negative class values, which have no colour".format(class_path))
+    n_classes = max(max(int(class_row[0]) for class_row in class_color_key), int(class_array.max())) + 1
+    lut = np.zeros((3, n_classes), dtype=np.uint8)
+    for class_row in class_color_key:
+        lut[:, int(class_row[0])] = [int(value) for value in class_row[1:4]]
+    # Every class value is within the table, so clip never changes an index; it just lets take write straight into
+    # the display layer without the temporary copy that mode="raise" makes
+    for band_index, band_lut in enumerate(lut):
+        np.take(band_lut, class_array, out=display_array[band_index, ...], mode="clip")
     display_array = None
     class_array = None
     gdal.ReprojectImage(display_raster, dst_wkt=SRS)
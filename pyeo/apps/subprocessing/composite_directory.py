@@ -40,10 +40,13 @@ if __name__ == "__main__":
 
     if args.merge_path:
         comp_dir = args.merge_path
-        for safe_file in [os.path.join(os.path.dirname(args.in_dir), file) for file in os.listdir(args.in_dir)]:
-            pyeo.raster_manipulation.stack_sentinel_2_bands(safe_file, comp_dir)
+        # Each .SAFE is stacked as the scan reaches it, rather than after the whole directory has been listed
+        with os.scandir(args.in_dir) as safe_entries:
+            for safe_entry in safe_entries:
+                pyeo.raster_manipulation.stack_sentinel_2_bands(safe_entry.path, comp_dir)
 
     if args.mask_path:
+        # Listed up front, since the masks are written into the directory being listed
         for image in [os.path.join(os.path.dirname(comp_dir), file) for file in os.listdir(comp_dir)]:
             pyeo.raster_manipulation.create_mask_from_model(image, args.mask_path)
 
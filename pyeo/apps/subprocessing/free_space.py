@@ -25,18 +25,22 @@ def free_space(aoi_dir, images_to_keep, with_warning=True):
 
 def remove_old_images(image_dir, images_to_keep, with_warning=True):
     """Removes all but the latest images from image_dir."""
-    images = pyeo.filesystem_utilities.sort_by_timestamp(os.listdir(image_dir))
+    # The directory is scanned once; each entry knows whether it is a file without a stat of its own
+    with os.scandir(image_dir) as scan:
+        entries = {entry.name: entry for entry in scan}
+    images = pyeo.filesystem_utilities.sort_by_timestamp(entries)
     if with_warning:
         if not input(
                 "About to delete {} files from {}: Y/N?".format(len(images[images_to_keep:]), image_dir)).upper().\
                 startswith("Y"):
             return
+    pyeo.filesystem_utilities.close_cached_datasets()
     for image_name in images[images_to_keep:]:
-        image_path = os.path.join(image_dir, image_name)
-        if os.path.isfile(image_path):
-            os.remove(image_path)
+        entry = entries[image_name]
+        if entry.is_file():
+            os.remove(entry.path)
         else:
-            shutil.rmtree(image_path)
+            shutil.rmtree(entry.path)
 
 
 if __name__ == "__main__":
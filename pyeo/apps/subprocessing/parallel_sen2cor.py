@@ -17,6 +17,7 @@ def moveL2(from_path, to_path):
 
     #TODO Test
 
+    pyeo.filesystem_utilities.close_cached_datasets()
     if os.path.exists(to_path):
         shutil.rmtree(to_path)
     shutil.copytree(from_path, to_path)
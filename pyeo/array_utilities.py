@@ -11,4 +11,13 @@ def project_array(array_in, depth, axis):
     """Returns a new array with an extra dimension. Data is projected along that dimension to depth."""
     array_in = np.expand_dims(array_in, axis)
     array_in = np.repeat(array_in, depth, axis)
-    return array_in
\ No newline at end of file
+    return array_in
+
+
+def project_array_view(array_in, depth, axis):
+    """Returns a read-only view of array_in with an extra dimension of size depth. Unlike project_array, no data is
+    copied; every position along the new dimension refers to the same memory."""
+    array_in = np.expand_dims(array_in, axis)
+    shape = list(array_in.shape)
+    shape[axis] = depth
+    return np.broadcast_to(array_in, shape)
@@ -24,22 +24,33 @@ Function reference
 ------------------
 """
 import csv
+import functools
 import glob
 import logging
 import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from tempfile import TemporaryDirectory
 
 import gdal
 import joblib
 import numpy as np
 from osgeo import osr
-from scipy import sparse as sp
 from sklearn import ensemble as ens
 from sklearn.externals import joblib as sklearn_joblib
 from sklearn.model_selection import cross_val_score
 
+try:
+    import pandas as pd
+except ImportError:
+    pd = None
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
 from pyeo.coordinate_manipulation import get_local_top_left
-from pyeo.filesystem_utilities import get_mask_path
+from pyeo.filesystem_utilities import get_mask_path, prefetch_files
 
 from pyeo.raster_manipulation import stack_images, create_matching_dataset, apply_array_image_mask, get_masked_array
 
@@ -84,7 +95,7 @@ def change_from_composite(image_path, composite_path, model_path, class_out_path
 
 
 def classify_image(image_path, model_path, class_out_path, prob_out_path=None,
-                   apply_mask=False, out_type="GTiff", num_chunks=10, nodata=0, skip_existing = False):
+                   apply_mask=False, out_type="GTiff", num_chunks=10, nodata=0, skip_existing = False, n_jobs=None):
     """
     Produces a class map from a raster and a model.
     This applies the model's fit() function to each pixel in the input raster, and saves the result into an output
@@ -95,8 +106,9 @@ def classify_image(image_path, model_path, class_out_path, prob_out_path=None,
     ----------
     image_path : str
         The path to the raster image to be classified.
-    model_path : str
-        The path to the .pkl file containing the model
+    model_path : str or sklearn.classifier
+        The path to the .pkl file containing the model, or an already loaded model. The model's n_jobs is held at 1
+        while the image is classified, as predictions are already spread over n_jobs threads, and restored afterwards.
     class_out_path : str
         The path that the classified map will be saved at.
     prob_out_path : str, optional
@@ -106,12 +118,14 @@ def classify_image(image_path, model_path, class_out_path, prob_out_path=None,
     out_type : str, optional
         The raster format of the class image. Defaults to "GTiff" (geotif). See gdal docs for valid types.
     num_chunks : int, optional
-        The number of chunks the image is broken into prior to classification. The smaller this number, the faster
+        The number of strips of rows the image is broken into for classification. The smaller this number, the faster
         classification will run - but the more likely you are to get a outofmemory error. Default 10.
     nodata : int, optional
         The value to write to masked pixels. Defaults to 0.
     skip_existing : bool, optional
         If true, do not run if class_out_path already exists. Defaults to False.
+    n_jobs : int, optional
+        The number of threads that predict each strip. Defaults to the number of CPUs on the machine.
 
 
     Notes
@@ -132,22 +146,19 @@ def classify_image(image_path, model_path, class_out_path, prob_out_path=None,
             log.info("Class image exists, skipping.")
             return class_out_path
     log.info("Classifying file: {}".format(image_path))
-    log.info("Saved model     : {}".format(model_path))
     image = gdal.Open(image_path)
+    if hasattr(model_path, "predict"):
+        model = model_path
+    else:
+        log.info("Saved model     : {}".format(model_path))
+        model = _load_model(model_path, os.path.getmtime(model_path))
     if num_chunks == None:
         log.info("No chunk size given, attempting autochunk.")
-        num_chunks = autochunk(image)
+        num_chunks = autochunk(image, n_classes=getattr(model, "n_classes_", 0) if prob_out_path else 0)
         log.info("Autochunk to {} chunks".format(num_chunks))
-    try:
-        model = sklearn_joblib.load(model_path)
-    except KeyError:
-        log.warning("Sklearn joblib import failed,trying generic joblib")
-        model = joblib.load(model_path)
-    except TypeError:
-        log.warning("Sklearn joblib import failed,trying generic joblib")
-        model = joblib.load(model_path)
     class_out_image = create_matching_dataset(image, class_out_path, format=out_type, datatype=gdal.GDT_Byte)
     log.info("Created classification image file: {}".format(class_out_path))
+    prob_out_image = None
     if prob_out_path:
         try:
             log.info("n classes in the model: {}".format(model.n_classes_))
@@ -156,88 +167,67 @@ def classify_image(image_path, model_path, class_out_path, prob_out_path=None,
         prob_out_image = create_matching_dataset(image, prob_out_path, bands=model.n_classes_, datatype=gdal.GDT_Float32)
         log.info("Created probability image file: {}".format(prob_out_path))
     model.n_cores = -1
-    image_array = image.GetVirtualMemArray()
+    # Each strip is split across threads and predicted a piece per thread; sklearn's predict() releases the GIL in
+    # its compiled code. Ensembles are held to one job each so that they don't also fan out over their trees on top.
+    # The model may be the caller's or the one shared by _load_model's cache, so its n_jobs is put back afterwards.
+    has_n_jobs = hasattr(model, "n_jobs")
+    if has_n_jobs:
+        model_n_jobs = model.n_jobs
+        model.n_jobs = 1
 
     if apply_mask:
         mask_path = get_mask_path(image_path)
         log.info("Applying mask at {}".format(mask_path))
         mask = gdal.Open(mask_path)
-        mask_array = mask.GetVirtualMemArray()
-        image_array = apply_array_image_mask(image_array, mask_array)
-        mask_array = None
+    else:
         mask = None
 
-    # Mask out missing values from the classification
-    # at this point, image_array has dimensions [band, y, x]
-    log.info("Reshaping image from GDAL to Scikit-Learn dimensions")
-    image_array = reshape_raster_for_ml(image_array)
-    # Now it has dimensions [x * y, band] as needed for Scikit-Learn
-
-    # Determine where in the image array there are no missing values in any of the bands (axis 1)
-    log.info("Finding good pixels without missing values")
-    log.info("image_array.shape = {}".format(image_array.shape))
-    n_samples = image_array.shape[0]  # gives x * y dimension of the whole image
-    good_mask = np.all(image_array != nodata, axis=1)
-    good_sample_count = np.count_nonzero(good_mask)
-    log.info("No. good values: {}".format(good_sample_count))
-    #if good_sample_count <= 0.5*len(good_mask):  # If the images is less than 50% good pixels, do filtering
-    if 1 == 0:  # Removing the filter until we fix the classification issue with it
-        log.info("Filtering nodata values")
-        good_indices = np.nonzero(good_mask)
-        good_samples = np.take(image_array, good_indices, axis=0).squeeze()
-        n_good_samples = len(good_samples)
-    else:
-        #log.info("Not worth filtering nodata, skipping.")
-        good_samples = image_array
-        good_indices = range(0, n_samples)
-        n_good_samples = n_samples
-    log.info("   All  samples: {}".format(n_samples))
+    # The image is classified in strips of whole rows, so only one strip of [band, y, x] is ever held in memory and
+    # each strip's classes can be written straight back to the same rows of the output.
+    # The next strip is read and the previous strip written on their own threads while the current strip is being
+    # classified. gdal datasets aren't safe to share between threads, so the reader gets its own handle and the
+    # output datasets are only touched by the writer from here on.
+    width = image.RasterXSize
+    height = image.RasterYSize
+    num_chunks = max(1, min(num_chunks, height))
+    strip_height = int(np.ceil(height / num_chunks))
+    # Strips are cut on block row boundaries where they can be, so that no block of a tiled or striped input is read
+    # (and decompressed) once for each of two strips; rounding down keeps each strip within autochunk's budget.
+    block_height = image.GetRasterBand(1).GetBlockSize()[1]
+    if block_height < strip_height < height:
+        strip_height -= strip_height % block_height
+    strips = [(y_offset, min(strip_height, height - y_offset)) for y_offset in range(0, height, strip_height)]
+    log.info("   Number of strips {} Strip height {}".format(len(strips), strip_height))
+    read_image = gdal.Open(image_path)
+    n_good_samples = 0
+    # One thread pool serves the predictions for every strip, rather than a new one being set up per strip
+    try:
+        with ThreadPoolExecutor(max_workers=1) as reader, ThreadPoolExecutor(max_workers=1) as writer, \
+                joblib.Parallel(n_jobs=n_jobs or joblib.cpu_count(), backend="threading") as predict_pool:
+            next_read = reader.submit(_read_strip, read_image, mask, *strips[0])
+            pending_write = None
+            for strip_index, (y_offset, rows) in enumerate(strips):
+                log.info("   Classifying rows {} to {}".format(y_offset, y_offset + rows))
+                image_array = next_read.result()
+                if strip_index + 1 < len(strips):
+                    next_read = reader.submit(_read_strip, read_image, mask, *strips[strip_index + 1])
+                class_strip, prob_strip, good_sample_count = _classify_strip(
+                    image_array, model, nodata, bool(prob_out_path), predict_pool)
+                n_good_samples += good_sample_count
+                image_array = None
+                if pending_write is not None:
+                    pending_write.result()  # Only one strip of output is ever waiting to be written
+                pending_write = writer.submit(_write_strip, class_out_image, prob_out_image, class_strip, prob_strip,
+                                              y_offset)
+            pending_write.result()
+    finally:
+        if has_n_jobs:
+            model.n_jobs = model_n_jobs
+
+    log.info("   All  samples: {}".format(width * height))
     log.info("   Good samples: {}".format(n_good_samples))
-    classes = np.full(n_good_samples, nodata, dtype=np.ubyte)
-    if prob_out_path:
-        probs = np.full((n_good_samples, model.n_classes_), nodata, dtype=np.float32)
-
-    chunk_size = int(n_good_samples / num_chunks)
-    chunk_resid = n_good_samples - (chunk_size * num_chunks)
-    log.info("   Number of chunks {} Chunk size {} Chunk residual {}".format(num_chunks, chunk_size, chunk_resid))
-    # The chunks iterate over all values in the array [x * y, bands] always with 8 bands per chunk
-    for chunk_id in range(num_chunks):
-        offset = chunk_id * chunk_size
-        # process the residual pixels with the last chunk
-        if chunk_id == num_chunks - 1:
-            chunk_size = chunk_size + chunk_resid
-        log.info("   Classifying chunk {} of size {}".format(chunk_id, chunk_size))
-        chunk_view = good_samples[offset : offset + chunk_size]
-        #indices_view = good_indices[offset : offset + chunk_size]
-        out_view = classes[offset : offset + chunk_size]  # dimensions [chunk_size]
-        out_view[:] = model.predict(chunk_view)
-
-        if prob_out_path:
-            log.info("   Calculating probabilities")
-            prob_view = probs[offset : offset + chunk_size, :]
-            prob_view[:, :] = model.predict_proba(chunk_view)
-
-    log.info("   Creating class array of size {}".format(n_samples))
-    class_out_array = np.full((n_samples), nodata)
-    for i, class_val in zip(good_indices, classes):
-        class_out_array[i] = class_val
-
-    log.info("   Creating GDAL class image")
-    class_out_image.GetVirtualMemArray(eAccess=gdal.GF_Write)[:, :] = \
-        reshape_ml_out_to_raster(class_out_array, image.RasterXSize, image.RasterYSize)
-
-    if prob_out_path:
-        log.info("   Creating probability array of size {}".format(n_samples * model.n_classes_))
-        prob_out_array = np.full((n_samples, model.n_classes_), nodata)
-        for i, prob_val in zip(good_indices, probs):
-            prob_out_array[i] = prob_val
-        log.info("   Creating GDAL probability image")
-        log.info("   N Classes = {}".format(prob_out_array.shape[1]))
-        log.info("   Image X size = {}".format(image.RasterXSize))
-        log.info("   Image Y size = {}".format(image.RasterYSize))
-        prob_out_image.GetVirtualMemArray(eAccess=gdal.GF_Write)[:, :, :] = \
-            reshape_prob_out_to_raster(prob_out_array, image.RasterXSize, image.RasterYSize)
-
+    mask = None
+    read_image = None
     class_out_image = None
     prob_out_image = None
     if prob_out_path:
@@ -246,20 +236,162 @@ def classify_image(image_path, model_path, class_out_path, prob_out_path=None,
         return class_out_path
 
 
-def autochunk(dataset, mem_limit=None):
+@functools.lru_cache(maxsize=4)
+def _load_model(model_path, mtime):
+    """
+    :meta private:
+    Loads a pickled model, keeping the last few in memory. mtime is part of the cache key so that a model file
+    that is retrained in place gets reloaded. Each process that loads a model holds its own copy of it.
+    """
+    try:
+        model = sklearn_joblib.load(model_path)
+    except KeyError:
+        log.warning("Sklearn joblib import failed,trying generic joblib")
+        model = joblib.load(model_path)
+    except TypeError:
+        log.warning("Sklearn joblib import failed,trying generic joblib")
+        model = joblib.load(model_path)
+    return model
+
+
+def _read_strip(image, mask, y_offset, rows):
     """
+    Reads rows [y_offset, y_offset + rows) of every band of image as a [band, y, x] array, with the pixels masked out
+    by mask (if not None) set to 0.
+
     :meta private:
-    EXPERIMENTAL Calculates the number of chunks to break a dataset into without a memory error. Presumes that 80% of the
-    memory on the host machine is available for use by Pyeo.
-    We want to break the dataset into as few chunks as possible without going over mem_limit.
-    mem_limit defaults to total amount of RAM available on machine if not specified
+    """
+    image_array = image.ReadAsArray(0, y_offset, image.RasterXSize, rows)
+    if image_array.ndim == 2:
+        image_array = image_array[np.newaxis, ...]
+    if mask is not None:
+        mask_array = mask.GetRasterBand(1).ReadAsArray(0, y_offset, image.RasterXSize, rows)
+        # The strip was just read, so masked pixels are zeroed in place rather than copied into a new array
+        image_array[:, mask_array != 1] = 0
+    return image_array
+
+
+def _classify_strip(image_array, model, nodata, get_probs, predict_pool):
+    """
+    Classifies every pixel of a [band, y, x] strip that has no nodata value in any band. Returns the [y, x] class
+    strip, the [class, y, x] probability strip (None unless get_probs) and the number of pixels classified.
+
+    :meta private:
+    """
+    bands, rows, width = image_array.shape
+    # Determine where in the strip there are no missing values in any of the bands. Bands whose range in this
+    # strip doesn't include nodata can't hold it, so only the remaining bands are compared pixel by pixel, one
+    # contiguous band plane at a time.
+    band_mins = image_array.min(axis=(1, 2))
+    band_maxs = image_array.max(axis=(1, 2))
+    nodata_bands = np.flatnonzero((band_mins <= nodata) & (band_maxs >= nodata))
+    if nodata_bands.size:
+        good_mask = image_array[nodata_bands[0]] != nodata
+        for band_index in nodata_bands[1:]:
+            good_mask &= image_array[band_index] != nodata
+        good_mask = good_mask.ravel()
+        good_sample_count = np.count_nonzero(good_mask)
+    else:
+        good_sample_count = rows * width
+    if good_sample_count == rows * width:
+        good_mask = slice(None)  # every pixel is good, so skip the boolean gather and scatter
+    image_array = reshape_raster_for_ml(image_array)
+    # Now it has dimensions [x * y, band] as needed for Scikit-Learn
+
+    class_out_array = np.full(image_array.shape[0], nodata, dtype=np.ubyte)
+    prob_out_array = None
+    if get_probs:
+        # Laid out as [class, pixel] from the start, so each class's strip is a contiguous block ready for writing
+        prob_out_array = np.full((model.n_classes_, image_array.shape[0]), nodata, dtype=np.float32)
+    if good_sample_count:
+        # Trees work on contiguous float32 internally; converting once here saves predict() and predict_proba()
+        # from each making their own copy of the strip
+        good_samples = np.ascontiguousarray(image_array[good_mask], dtype=np.float32)
+        if get_probs:
+            # Probabilities are stored as float32, so they are narrowed from predict_proba's float64 as each piece
+            # comes back
+            probs = _predict_in_threads(model.predict_proba, good_samples, predict_pool, dtype=np.float32)
+            prob_out_array[:, good_mask] = probs.T
+            if isinstance(model, (ens.RandomForestClassifier, ens.ExtraTreesClassifier)):
+                # A forest's predict() is the argmax of its predict_proba(), so reuse the probabilities rather than
+                # walking every tree a second time
+                class_out_array[good_mask] = model.classes_.take(np.argmax(probs, axis=1))
+            else:
+                class_out_array[good_mask] = _predict_in_threads(model.predict, good_samples, predict_pool,
+                                                                 dtype=np.ubyte)
+        else:
+            class_out_array[good_mask] = _predict_in_threads(model.predict, good_samples, predict_pool,
+                                                             dtype=np.ubyte)
+
+    class_strip = reshape_ml_out_to_raster(class_out_array, width, rows)
+    prob_strip = None
+    if get_probs:
+        prob_strip = prob_out_array.reshape((model.n_classes_, rows, width))
+    return class_strip, prob_strip, good_sample_count
+
+
+def _write_strip(class_out_image, prob_out_image, class_strip, prob_strip, y_offset):
+    """
+    Writes a class strip, and the probability strip if there is one, into the output images at row y_offset.
+
+    :meta private:
+    """
+    class_out_image.GetRasterBand(1).WriteArray(class_strip, 0, y_offset)
+    if prob_strip is not None:
+        for class_index in range(prob_strip.shape[0]):
+            prob_out_image.GetRasterBand(class_index + 1).WriteArray(prob_strip[class_index], 0, y_offset)
+
+
+def _predict_in_threads(predict, samples, predict_pool, dtype=None, min_piece_size=1000):
+    """
+    Calls predict on samples, split into up to one piece per worker of predict_pool (a threading joblib.Parallel)
+    that are predicted concurrently, and returns the concatenated results, cast to dtype if given. Pieces are kept to
+    at least min_piece_size samples, below which the thread overhead outweighs the gain; if that leaves a single
+    piece this is just predict(samples).
+
+    :meta private:
+    """
+    n_pieces = min(predict_pool.n_jobs, samples.shape[0] // min_piece_size)
+    if n_pieces <= 1:
+        return _predict_as(predict, samples, dtype)
+    pieces = np.array_split(samples, n_pieces)
+    results = predict_pool(joblib.delayed(_predict_as)(predict, piece, dtype) for piece in pieces)
+    return np.concatenate(results)
+
+
+def _predict_as(predict, samples, dtype=None):
+    """
+    Returns predict(samples), cast to dtype if given. Casting each piece as it is predicted means the full-width
+    result of, say, predict_proba's float64 never has to be held for the whole strip.
+
+    :meta private:
+    """
+    result = predict(samples)
+    if dtype is not None:
+        result = result.astype(dtype, copy=False)
+    return result
+
+
+def autochunk(dataset, mem_limit=None, n_classes=0, working_fraction=0.4):
+    """
+    :meta private:
+    EXPERIMENTAL Calculates the number of chunks to break a dataset into for classify_image without a memory error.
+    We want to break the dataset into as few chunks as possible without the memory classify_image holds per chunk going
+    over mem_limit.
+    mem_limit defaults to working_fraction of the memory available on the machine, less GDAL's block cache, if not
+    specified.
 
     Parameters
     ----------
     dataset
         The dataset to chunk
     mem_limit
-        The maximum amount of memory available to the process. Will be automatically populated from os.sysconf if missing.
+        The maximum amount of memory available to the process. Will be automatically populated from psutil (if
+        installed) or os.sysconf if missing.
+    n_classes
+        The number of classes whose probabilities are also being produced; 0 if no probability image is being made.
+    working_fraction
+        The fraction of available memory to budget for classification when mem_limit is missing. Defaults to 0.4.
 
     Returns
     -------
@@ -267,26 +399,32 @@ def autochunk(dataset, mem_limit=None):
 
     """
     pixels = dataset.RasterXSize * dataset.RasterYSize
-    bytes_per_pixel = dataset.GetVirtualMemArray().dtype.itemsize*dataset.RasterCount
-    image_bytes = bytes_per_pixel*pixels
+    # The band's datatype gives the pixel size without having to map the whole image
+    in_bytes = gdal.GetDataTypeSize(dataset.GetRasterBand(1).DataType)//8 * dataset.RasterCount
+    # Per pixel, classify_image holds the strip being classified and the one being prefetched, the strip reshaped
+    # for scikit-learn and its float32 copy, and the class (and float32 probability) strips for both the strip being
+    # classified and the one waiting to be written, plus predict_proba's own float64 output.
+    bytes_per_pixel = 3*in_bytes + 4*dataset.RasterCount + 2*1 + n_classes*(2*4 + 8)
+    chunk_bytes = bytes_per_pixel*pixels
     if not mem_limit:
-        mem_limit = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES')
-        # Lets assume that 20% of memory is being used for non-map bits
-        mem_limit = int(mem_limit*0.8)
-    # if I went back now, I would fail basic programming here.
-    for num_chunks in range(1, pixels):
-        if pixels % num_chunks != 0:
-            continue
-        chunk_size_bytes = (pixels/num_chunks)*bytes_per_pixel
-        if chunk_size_bytes < mem_limit:
-            return num_chunks
+        if psutil is not None:
+            available = psutil.virtual_memory().available
+        else:
+            available = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES')
+        # GDAL's block cache fills up alongside the arrays, so it comes out of the budget first
+        mem_limit = max(1, int((available - gdal.GetCacheMax()) * working_fraction))
+    # classify_image copes with chunks that don't divide the image evenly, so this is just a ceiling division
+    return max(1, -(-chunk_bytes // mem_limit))
 
 
 def classify_directory(in_dir, model_path, class_out_dir, prob_out_dir = None,
-                       apply_mask=False, out_type="GTiff", num_chunks=10):
+                       apply_mask=False, out_type="GTiff", num_chunks=10, n_workers=1, skip_existing=False):
     """
     Classifies every file ending in .tif in in_dir using model at model_path. Outputs are saved
     in class_out_dir and prob_out_dir, named [input_name]_class and _prob, respectively.
+    If n_workers is more than 1, the images are classified in that many processes at once, with the CPUs shared out
+    between them; this is fastest for many small images. Large images are best left to the default of 1, where each
+    image in turn is classified across every CPU.
 
     See the documentation for classification.classify_image() for more details.
 
@@ -306,22 +444,81 @@ def classify_directory(in_dir, model_path, class_out_dir, prob_out_dir = None,
     out_type : str, optional
         The raster format of the class image. Defaults to "GTiff" (geotif). See gdal docs for valid datatypes.
     num_chunks : int, optional
-        The number of chunks to break each image into for processing. See :py:func:`classify_image`
+        The number of chunks to break each image into for processing. See :py:func:`classify_image`. If None and
+        n_workers is more than 1, each image is autochunked on its share of the available memory.
+    n_workers : int, optional
+        The number of images to classify at once, capped at the number of images and CPUs. None uses one per CPU.
+        Defaults to 1.
+    skip_existing : bool, optional
+        If True, skips any image whose class map in class_out_dir was written after both the image and the model were
+        last changed. Defaults to False.
 
     """
     log = logging.getLogger(__name__)
     log.info("Classifying files in {}".format(in_dir))
     log.info("Class files saved in {}".format(class_out_dir))
     log.info("Prob. files saved in {}".format(prob_out_dir))
-    for image_path in glob.glob(in_dir+r"/*.tif"):
+    image_paths = glob.glob(in_dir+r"/*.tif")
+    out_paths = []
+    for image_path in image_paths:
         image_name = os.path.basename(image_path).split('.')[0]
         class_out_path = os.path.join(class_out_dir, image_name+"_class.tif")
         if prob_out_dir:
             prob_out_path = os.path.join(prob_out_dir, image_name+"_prob.tif")
         else:
             prob_out_path = None
-        classify_image(image_path, model_path, class_out_path, prob_out_path,
-                       apply_mask, out_type, num_chunks)
+        out_paths.append((class_out_path, prob_out_path))
+    model_mtime = os.path.getmtime(model_path)
+    if skip_existing:
+        # A class map is only out of date if the image or the model has changed since it was written
+        to_classify = []
+        for image_path, image_out_paths in zip(image_paths, out_paths):
+            class_out_path = image_out_paths[0]
+            if os.path.exists(class_out_path) and \
+                    os.path.getmtime(class_out_path) > max(os.path.getmtime(image_path), model_mtime):
+                log.info("{} is up to date, skipping".format(class_out_path))
+            else:
+                to_classify.append((image_path, image_out_paths))
+        image_paths = [image_path for image_path, _ in to_classify]
+        out_paths = [image_out_paths for _, image_out_paths in to_classify]
+        if not image_paths:
+            return
+    cpu_count = joblib.cpu_count()
+    n_workers = max(1, min(n_workers or cpu_count, len(image_paths), cpu_count))
+    if n_workers == 1:
+        # The model is loaded once and handed to every classify_image call
+        model = _load_model(model_path, model_mtime)
+        for index, (image_path, (class_out_path, prob_out_path)) in enumerate(zip(image_paths, out_paths)):
+            # The next image (and its mask) is read into the page cache while this one is being classified
+            if index + 1 < len(image_paths):
+                next_image_path = image_paths[index + 1]
+                prefetch_files([next_image_path, get_mask_path(next_image_path)] if apply_mask else [next_image_path])
+            classify_image(image_path, model, class_out_path, prob_out_path,
+                           apply_mask, out_type, num_chunks)
+        return
+    # Each image's prediction threads get an equal share of the CPUs, so that workers * threads doesn't go over the
+    # number of cores. Likewise, autochunking in each worker would budget on all of the free memory at once, so each
+    # image's chunks are worked out here on an equal share of it instead.
+    threads_per_image = max(1, cpu_count // n_workers)
+    log.info("Classifying {} images in {} processes of {} threads".format(len(image_paths), n_workers,
+                                                                         threads_per_image))
+    if num_chunks is None:
+        n_classes = getattr(_load_model(model_path, model_mtime), "n_classes_", 0) \
+            if prob_out_dir else 0
+        image_chunks = [autochunk(gdal.Open(image_path), n_classes=n_classes, working_fraction=0.4 / n_workers)
+                        for image_path in image_paths]
+    else:
+        image_chunks = [num_chunks] * len(image_paths)
+    # Each worker loads the model once as it starts, into _load_model's cache, rather than a pickled copy of the model
+    # being sent along with every image
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=_load_model,
+                             initargs=(model_path, model_mtime)) as pool:
+        jobs = [pool.submit(classify_image, image_path, model_path, class_out_path, prob_out_path,
+                            apply_mask, out_type, image_num_chunks, n_jobs=threads_per_image)
+                for image_path, (class_out_path, prob_out_path), image_num_chunks
+                in zip(image_paths, out_paths, image_chunks)]
+        for job in jobs:
+            job.result()
 
 
 def reshape_raster_for_ml(image_array):
@@ -474,20 +671,20 @@ def create_trained_model(training_image_file_paths, cross_val_repeats = 5, attri
             min_samples_leaf=2, min_samples_split=16, n_estimators=100, n_jobs=4, class_weight='balanced')
 
     """
-    # This could be optimised by pre-allocating the training array. but not now.
-    learning_data = None
-    classes = None
+    # Each image's samples are collected and joined once at the end, rather than regrowing one array per image
+    data_chunks = []
+    class_chunks = []
     for training_image_file_path in training_image_file_paths:
         training_image_folder, training_image_name = os.path.split(training_image_file_path)
         training_image_name = training_image_name[:-4]  # Strip the file extension
         shape_path = os.path.join(training_image_folder, training_image_name, training_image_name + '.shp')
         this_training_data, this_classes = get_training_data(training_image_file_path, shape_path, attribute)
-        if learning_data is None:
-            learning_data = this_training_data
-            classes = this_classes
-        else:
-            learning_data = np.append(learning_data, this_training_data, 0)
-            classes = np.append(classes, this_classes)
+        # Trees split on float32 thresholds and fit() converts to contiguous float32 anyway, so doing it here per
+        # image means the joined array (and cross_val_score's folds of it) is half the size and not copied again
+        data_chunks.append(this_training_data.astype(np.float32))
+        class_chunks.append(this_classes)
+    learning_data = np.concatenate(data_chunks, axis=0)
+    classes = np.concatenate(class_chunks)
     model = ens.ExtraTreesClassifier(bootstrap=False, criterion="gini", max_features=0.55, min_samples_leaf=2,
                                      min_samples_split=16, n_estimators=100, n_jobs=4, class_weight='balanced')
     model.fit(learning_data, classes)
@@ -548,7 +745,7 @@ def create_model_from_signatures(sig_csv_path, model_out, sig_datatype=np.int32)
     model = ens.ExtraTreesClassifier(bootstrap=False, criterion="gini", max_features=0.55, min_samples_leaf=2,
                                      min_samples_split=16, n_estimators=100, n_jobs=4, class_weight='balanced')
     features, labels = load_signatures(sig_csv_path, sig_datatype)
-    model.fit(features, labels)
+    model.fit(np.ascontiguousarray(features, dtype=np.float32), labels)
     joblib.dump(model, model_out)
 
 
@@ -570,8 +767,13 @@ def load_signatures(sig_csv_path, sig_datatype=np.int32):
         a 1d numpy array of class labels corresponding to the samples in features.
 
     """
-    data = np.genfromtxt(sig_csv_path, delimiter=",", dtype=sig_datatype).T
-    return (data[1:, :].T, data[0, :])
+    # pandas' C parser is far quicker than genfromtxt's line-by-line Python one on large signature files, so it's used
+    # when installed
+    if pd is not None:
+        data = pd.read_csv(sig_csv_path, header=None, dtype=sig_datatype).to_numpy()
+    else:
+        data = np.genfromtxt(sig_csv_path, delimiter=",", dtype=sig_datatype)
+    return (data[:, 1:], data[:, 0])
 
 
 def get_training_data(image_path, shape_path, attribute="CODE", shape_projection_id=4326):
@@ -630,18 +832,19 @@ def get_training_data(image_path, shape_path, attribute="CODE", shape_projection
         rasterised_shapefile = gdal.Open(ras_path)
         shape_array = rasterised_shapefile.GetVirtualMemArray()
         local_x, local_y = get_local_top_left(image, rasterised_shapefile)
-        shape_sparse = sp.coo_matrix(np.asarray(shape_array).squeeze())
-        y, x, features = sp.find(shape_sparse)
-        training_data = np.empty((len(features), image.RasterCount))
-        image_array = image.GetVirtualMemArray()
-        image_view = image_array[:,
-                    local_y: local_y + rasterised_shapefile.RasterYSize,
-                    local_x: local_x + rasterised_shapefile.RasterXSize
-                    ]
-        for index in range(len(features)):
-            training_data[index, :] = image_view[:, y[index], x[index]]
+        shape_labels = np.asarray(shape_array).squeeze()
+        y, x = np.nonzero(shape_labels)
+        features = shape_labels[y, x]
+        # The part of the image under the shapefile is read in one sequential read, rather than the labelled pixels
+        # being faulted in one at a time from a mapped image, then every labelled pixel is gathered in one call.
+        # Rows of training_data are pixels, columns are bands.
+        image_view = image.ReadAsArray(local_x, local_y,
+                                       min(rasterised_shapefile.RasterXSize, image.RasterXSize - local_x),
+                                       min(rasterised_shapefile.RasterYSize, image.RasterYSize - local_y))
+        if image_view.ndim == 2:
+            image_view = image_view[np.newaxis, ...]
+        training_data = np.ascontiguousarray(image_view[:, y, x].T, dtype=np.float64)
         image_view = None
-        image_array = None
         shape_array = None
         rasterised_shapefile = None
         return training_data, features
@@ -666,7 +869,7 @@ def raster_reclass_binary(img_path, rcl_value, outFn, outFmt='GTiff', write_out=
 
     Returns
     -------
-    Reclassifies numpy array
+    Reclassifies numpy array, as uint8
     """
     log = logging.getLogger(__name__)
     log.info('Starting raster reclassification.')
@@ -675,9 +878,9 @@ def raster_reclass_binary(img_path, rcl_value, outFn, outFmt='GTiff', write_out=
     in_band = in_ds.GetRasterBand(1)
     in_array = in_band.ReadAsArray()
 
-    # reclassify
-    in_array[in_array != rcl_value] = 0
-    in_array[in_array == rcl_value] = 1
+    # reclassify. The result is only ever 0 or 1, so it is built as uint8 in a single comparison rather than by two
+    # masked assignments over the class raster's own, usually wider, datatype
+    in_array = np.equal(in_array, rcl_value).view(np.uint8)
 
     if write_out:
         driver = gdal.GetDriverByName(outFmt)
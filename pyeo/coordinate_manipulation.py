@@ -21,6 +21,7 @@ Key functions
 Function reference
 ------------------
 """
+import functools
 import subprocess
 
 import numpy as np
@@ -75,9 +76,7 @@ def get_combined_polygon(rasters, geometry_mode ="intersect"):
         ogr.Geometry() containing a polygon.
 
     """
-    raster_bounds = []
-    for in_raster in rasters:
-        raster_bounds.append(get_raster_bounds(in_raster))
+    raster_bounds = [get_raster_bounds(in_raster) for in_raster in rasters]
     # Calculate overall bounding box based on either union or intersection of rasters
     if geometry_mode == "intersect":
         combined_polygons = multiple_intersection(raster_bounds)
@@ -103,12 +102,17 @@ def multiple_union(polygons):
         An ogr.Geometry object containing a single polygon
 
     """
-    # Note; I can see this maybe failing(or at least returning a multipolygon)
-    # if two consecutive polygons do not overlap at all. Keep eye on.
-    running_union = polygons[0]
-    for polygon in polygons[1:]:
-        running_union = running_union.Union(polygon)
-    return running_union.Simplify(0)
+    # Note; this will return a multipolygon if the polygons do not all overlap.
+    # UnionCascaded unions the whole collection in one GEOS call instead of folding Union pairwise,
+    # which re-noded the growing running union once per polygon.
+    collection = ogr.Geometry(ogr.wkbMultiPolygon)
+    for polygon in polygons:
+        if polygon.GetGeometryType() in (ogr.wkbMultiPolygon, ogr.wkbMultiPolygon25D):
+            for part_index in range(polygon.GetGeometryCount()):
+                collection.AddGeometry(polygon.GetGeometryRef(part_index))
+        else:
+            collection.AddGeometry(polygon)
+    return collection.UnionCascaded().Simplify(0)
 
 
 def multiple_intersection(polygons):
@@ -128,6 +132,8 @@ def multiple_intersection(polygons):
     running_intersection = polygons[0]
     for polygon in polygons[1:]:
         running_intersection = running_intersection.Intersection(polygon)
+        if running_intersection.IsEmpty():
+            break
     return running_intersection.Simplify(0)
 
 
@@ -155,8 +161,9 @@ def pixel_bounds_from_polygon(raster, polygon):
     intersection = get_poly_intersection(raster_bounds, polygon)
     bounds_geo = intersection.Boundary()
     x_min_geo, x_max_geo, y_min_geo, y_max_geo = bounds_geo.GetEnvelope()
-    (x_min_pixel, y_min_pixel) = point_to_pixel_coordinates(raster, (x_min_geo, y_min_geo))
-    (x_max_pixel, y_max_pixel) = point_to_pixel_coordinates(raster, (x_max_geo, y_max_geo))
+    x_pixels, y_pixels = points_to_pixel_coordinates(raster, (x_min_geo, x_max_geo), (y_min_geo, y_max_geo))
+    # tolist() hands back plain ints, which gdal's offset arguments need
+    (x_min_pixel, x_max_pixel), (y_min_pixel, y_max_pixel) = x_pixels.tolist(), y_pixels.tolist()
     # Kludge time: swap the two values around if they are wrong
     if x_min_pixel >= x_max_pixel:
         x_min_pixel, x_max_pixel = x_max_pixel, x_min_pixel
@@ -188,22 +195,56 @@ def point_to_pixel_coordinates(raster, point, oob_fail=False):
     The equation is a rearrangement of the section on affinine geotransform in http://www.gdal.org/gdal_datamodel.html
 
     """
-    if isinstance(point, str):
-        point = ogr.CreateGeometryFromWkt(point)
-        x_geo = point.GetX()
-        y_geo = point.GetY()
-    if isinstance(point, list) or isinstance(point, tuple):  # There is a more pythonic way to do this
-        x_geo = point[0]
-        y_geo = point[1]
-    if isinstance(point, ogr.Geometry):
+    if isinstance(point, (list, tuple)):
+        x_geo, y_geo = point[0], point[1]
+    else:
+        if isinstance(point, str):
+            point = ogr.CreateGeometryFromWkt(point)
         x_geo = point.GetX()
         y_geo = point.GetY()
-    gt = raster.GetGeoTransform()
-    x_pixel = int(np.floor((x_geo - floor_to_resolution(gt[0], gt[1]))/gt[1]))
-    y_pixel = int(np.floor((y_geo - floor_to_resolution(gt[3], gt[5]*-1))/gt[5]))  # y resolution is -ve
+    x_origin, x_res, y_origin, y_res = _pixel_grid(tuple(raster.GetGeoTransform()))
+    x_pixel = int(np.floor((x_geo - x_origin)/x_res))
+    y_pixel = int(np.floor((y_geo - y_origin)/y_res))  # y resolution is -ve
+    return x_pixel, y_pixel
+
+
+def points_to_pixel_coordinates(raster, x_geo, y_geo):
+    """
+    Vectorised form of :py:func:`point_to_pixel_coordinates`; converts arrays of geographic x and y coordinates into
+    arrays of pixel indicies in a north-up, non-rotated raster.
+
+    Parameters
+    ----------
+    raster : gdal.Image
+        A gdal raster object
+    x_geo : array_like
+        The x coordinates of the points
+    y_geo : array_like
+        The y coordinates of the points
+
+    Returns
+    -------
+    x_pixel, y_pixel : ndarray of int64
+        The pixel indicies of each point in the raster.
+
+    """
+    x_origin, x_res, y_origin, y_res = _pixel_grid(tuple(raster.GetGeoTransform()))
+    x_pixel = np.floor((np.asarray(x_geo, dtype=np.float64) - x_origin)/x_res).astype(np.int64)
+    y_pixel = np.floor((np.asarray(y_geo, dtype=np.float64) - y_origin)/y_res).astype(np.int64)  # y res is -ve
     return x_pixel, y_pixel
 
 
+@functools.lru_cache(maxsize=4096)
+def _pixel_grid(gt):
+    """
+    Returns (x_origin, x_res, y_origin, y_res) for a geotransform, with the origin floored to the resolution the same
+    way as :py:func:`get_raster_bounds`. Cached, as the same handful of geotransforms are converted over and over.
+
+    :meta private:
+    """
+    return floor_to_resolution(gt[0], gt[1]), gt[1], floor_to_resolution(gt[3], gt[5]*-1), gt[5]
+
+
 def pixel_to_point_coordinates(pixel, GT):
     """
     Given a pixel and a geotransformation, returns the picaltion of that pixel's top left corner in the projection
@@ -254,7 +295,7 @@ def write_geometry(geometry, out_path, srs_id=4326):
     data_source = driver.CreateDataSource(out_path)
     srs = osr.SpatialReference()
     if type(srs_id) is int:
-        srs.ImportFromEPSG(srs_id)
+        srs_id = epsg_to_wkt(srs_id)
     if type(srs_id) is str:
         srs.ImportFromWkt(srs_id)
     layer = data_source.CreateLayer(
@@ -292,15 +333,35 @@ def reproject_vector(in_path, out_path, dest_srs):
     """
 
     if type(dest_srs) == int:
-        epsg_no = dest_srs
-        dest_srs = osr.SpatialReference()
-        dest_srs.ImportFromEPSG(epsg_no)
+        dest_srs = epsg_to_wkt(dest_srs)
     if type(dest_srs) == osr.SpatialReference:
         dest_srs = dest_srs.ExportToWkt()
 
     subprocess.run(["ogr2ogr", out_path, in_path, '-t_srs', dest_srs])
 
 
+@functools.lru_cache(maxsize=64)
+def epsg_to_wkt(epsg):
+    """
+    Returns the wkt of the projection with the given EPSG number. Looking an EPSG code up means a query of PROJ's
+    database, so the result is cached; a run over many images of the same tile only looks each code up once.
+
+    Parameters
+    ----------
+    epsg : int
+        The EPSG number of the projection
+
+    Returns
+    -------
+    wkt : str
+        The projection as a wkt string
+
+    """
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(epsg)
+    return srs.ExportToWkt()
+
+
 def get_aoi_intersection(raster, aoi):
     """
     Returns a wkbPolygon geometry with the intersection of a raster and a shpefile containing an area of interest
@@ -404,14 +465,26 @@ def get_raster_bounds(raster):
     down to the nearest multiple of of the resolution of the geotransform. This is to avoid rounding errors in
     reprojected geotransformations.
     """
+    bounds_wkt = _raster_bounds_wkt(tuple(raster.GetGeoTransform()), raster.RasterXSize, raster.RasterYSize)
+    return ogr.CreateGeometryFromWkt(bounds_wkt)
+
+
+@functools.lru_cache(maxsize=4096)
+def _raster_bounds_wkt(geotrans, x_size, y_size):
+    """
+    Returns the wkt of the bounding rectangle of a raster with the given geotransform and size. Cached on
+    (geotransform, size) so that repeated bounds lookups on the same raster skip rebuilding the ring point by point;
+    get_raster_bounds still hands out a fresh geometry each call, since callers are free to mutate it.
+
+    :meta private:
+    """
     raster_bounds = ogr.Geometry(ogr.wkbLinearRing)
-    geotrans = raster.GetGeoTransform()
     # We can't rely on the top-left coord being whole numbers any more, since images may have been reprojected
     # So we floor to the resolution of the geotransform maybe?
     top_left_x = floor_to_resolution(geotrans[0], geotrans[1])
     top_left_y = floor_to_resolution(geotrans[3], geotrans[5]*-1)
-    width = geotrans[1]*raster.RasterXSize
-    height = geotrans[5]*raster.RasterYSize * -1  # RasterYSize is +ve, but geotransform is -ve
+    width = geotrans[1]*x_size
+    height = geotrans[5]*y_size * -1  # RasterYSize is +ve, but geotransform is -ve
     raster_bounds.AddPoint(top_left_x, top_left_y)
     raster_bounds.AddPoint(top_left_x + width, top_left_y)
     raster_bounds.AddPoint(top_left_x + width, top_left_y - height)
@@ -419,7 +492,7 @@ def get_raster_bounds(raster):
     raster_bounds.AddPoint(top_left_x, top_left_y)
     bounds_poly = ogr.Geometry(ogr.wkbPolygon)
     bounds_poly.AddGeometry(raster_bounds)
-    return bounds_poly
+    return bounds_poly.ExportToWkt()
 
 
 def floor_to_resolution(input, resolution):
@@ -19,11 +19,14 @@ Function reference
 
 import datetime
 import datetime as dt
+import functools
 import glob
 import logging
 import os
 import re
 import shutil
+import sys
+from concurrent.futures import ThreadPoolExecutor
 
 from pyeo.exceptions import CreateNewStacksException
 
@@ -32,6 +35,10 @@ import pyeo.windows_compatability
 
 # Set up logging on import
 log = logging.getLogger("pyeo")
+
+_SEN_2_TIMESTAMP_RE = re.compile(r"\d{8}T\d{6}")
+_SEN_2_TILE_RE = re.compile(r"T\d{2}[A-Z]{3}")  # Matches tile ID, but not timestamp
+_RGBN_BAND_RE = re.compile(r"_B0[2348].*\.jp2$")
 formatter = logging.Formatter("%(asctime)s: %(levelname)s: %(message)s")
 
 
@@ -84,7 +91,6 @@ def create_file_structure(root):
     root : str
         The root folder for the file strucutre
     """
-    os.chdir(root)
     dirs = [
         "images/",
         "images/L1/",
@@ -104,10 +110,7 @@ def create_file_structure(root):
         "log/"
     ]
     for dir in dirs:
-        try:
-            os.mkdir(dir)
-        except FileExistsError:
-            pass
+        os.makedirs(os.path.join(root, dir), exist_ok=True)
 
 
 def validate_config_file(config_path):
@@ -138,9 +141,7 @@ def check_for_invalid_l2_data(l2_SAFE_file, resolution="10m"):
         log.info("{} does not exist.".format(l2_SAFE_file))
         return 2
     log.info("Checking {} for incomplete {} imagery".format(l2_SAFE_file, resolution))
-    granule_path = r"GRANULE/*/IMG_DATA/R{}/*_B0[8,4,3,2]*.jp2".format(resolution)
-    image_glob = os.path.join(l2_SAFE_file, granule_path)
-    if len(glob.glob(image_glob)) == 4:
+    if _count_rgbn_band_files(l2_SAFE_file, os.path.join("IMG_DATA", "R{}".format(resolution))) == 4:
         return 1
     else:
         return 0
@@ -165,14 +166,33 @@ def check_for_invalid_l1_data(l1_SAFE_file):
         log.info("{} does not exist.".format(l1_SAFE_file))
         return 2
     log.info("Checking {} for incomplete imagery".format(l1_SAFE_file))
-    granule_path = r"GRANULE/*/IMG_DATA/*_B0[8,4,3,2]*.jp2"
-    image_glob = os.path.join(l1_SAFE_file, granule_path)
-    if len(glob.glob(image_glob)) == 4:
+    if _count_rgbn_band_files(l1_SAFE_file, "IMG_DATA") == 4:
         return 1
     else:
         return 0
 
 
+def _count_rgbn_band_files(safe_file, image_subdir):
+    """
+    :meta private:
+    Counts the band 2, 3, 4 and 8 .jp2 files in GRANULE/*/image_subdir of a .SAFE file. Lists each directory once
+    with os.scandir rather than globbing.
+    """
+    count = 0
+    try:
+        with os.scandir(os.path.join(safe_file, "GRANULE")) as granules:
+            granule_paths = [granule.path for granule in granules if granule.is_dir()]
+    except FileNotFoundError:
+        return 0
+    for granule_path in granule_paths:
+        try:
+            with os.scandir(os.path.join(granule_path, image_subdir)) as images:
+                count += sum(1 for image in images if _RGBN_BAND_RE.search(image.name))
+        except FileNotFoundError:
+            continue
+    return count
+
+
 def clean_l2_data(l2_SAFE_file, resolution="10m", warning=True):
     """
     Removes a safe file if it doesn't have bands 2, 3, 4 or 8 in the specified resolution folder.
@@ -186,11 +206,20 @@ def clean_l2_data(l2_SAFE_file, resolution="10m", warning=True):
     """
     is_valid = check_for_invalid_l2_data(l2_SAFE_file, resolution)
     if not is_valid:
-        if warning:
-            if not input("About to delete {}: Y/N?".format(l2_SAFE_file)).upper().startswith("Y"):
-                return
-        log.warning("Removing {}".format(l2_SAFE_file))
-        shutil.rmtree(l2_SAFE_file)
+        _remove_safe_file(l2_SAFE_file, warning)
+
+
+def _remove_safe_file(safe_file, warning):
+    """
+    :meta private:
+    Deletes safe_file, first asking the user for confirmation if warning is True.
+    """
+    if warning:
+        if not input("About to delete {}: Y/N?".format(safe_file)).upper().startswith("Y"):
+            return
+    log.warning("Removing {}".format(safe_file))
+    close_cached_datasets()
+    shutil.rmtree(safe_file)
 
 
 def clean_l2_dir(l2_dir, resolution="10m", warning=True):
@@ -212,8 +241,38 @@ def clean_l2_dir(l2_dir, resolution="10m", warning=True):
 
     """
     log.info("Scanning {} for incomplete SAFE files".format(l2_dir))
-    for safe_file_path in [os.path.join(l2_dir, safe_file_name) for safe_file_name in os.listdir(l2_dir)]:
-        clean_l2_data(safe_file_path, resolution, warning)
+    safe_file_paths = get_safe_dirs(l2_dir)
+    # Checking a .SAFE file is a handful of directory listings, which are mostly spent waiting on the disk, so larger
+    # directories are checked by several threads at once. Prompting and removal stay in this thread, in order.
+    if len(safe_file_paths) >= 4:
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            validity = list(executor.map(functools.partial(check_for_invalid_l2_data, resolution=resolution),
+                                         safe_file_paths))
+    else:
+        validity = [check_for_invalid_l2_data(safe_file_path, resolution) for safe_file_path in safe_file_paths]
+    for safe_file_path, is_valid in zip(safe_file_paths, validity):
+        if not is_valid:
+            _remove_safe_file(safe_file_path, warning)
+
+
+def get_safe_dirs(directory):
+    """
+    Returns the paths of the .SAFE folders in a directory, sorted by name. Any other files or folders in the
+    directory are left out. The directory is scanned once, without a separate stat for each entry.
+
+    Parameters
+    ----------
+    directory : str
+        The directory to scan, usually an L1 or L2 download folder.
+
+    Returns
+    -------
+    safe_dirs : list of str
+        The full paths of the .SAFE folders in directory.
+
+    """
+    with os.scandir(directory) as entries:
+        return sorted(entry.path for entry in entries if entry.name.endswith(".SAFE") and entry.is_dir())
 
 
 def clean_aoi(aoi_dir, images_to_keep=4, warning=True):
@@ -229,26 +288,49 @@ def clean_aoi(aoi_dir, images_to_keep=4, warning=True):
         The number of images to keep
 
     """
-    l1_list = sort_by_timestamp(os.listdir(os.path.join(aoi_dir, "images/L1")), recent_first=True)
-    l2_list = sort_by_timestamp(os.listdir(os.path.join(aoi_dir, "images/L2")), recent_first=True)
-    comp_l1_list = sort_by_timestamp(os.listdir(os.path.join(aoi_dir, "composite/L2")), recent_first=True)
-    comp_l2_list = sort_by_timestamp(os.listdir(os.path.join(aoi_dir, "composite/L2")), recent_first=True)
-    merged_list = sort_by_timestamp(
-        [image for image in os.listdir(os.path.join(aoi_dir, "images/merged")) if image.endswith(".tif")],
-        recent_first=True)
-    stacked_list = sort_by_timestamp(
-        [image for image in os.listdir(os.path.join(aoi_dir, "images/stacked")) if image.endswith(".tif")],
-        recent_first=True)
-    comp_merged_list = sort_by_timestamp(
-        [image for image in os.listdir(os.path.join(aoi_dir, "composite/merged")) if image.endswith(".tif")],
-        recent_first=True)
+    l1_list = get_sorted_image_paths(os.path.join(aoi_dir, "images/L1"))
+    l2_list = get_sorted_image_paths(os.path.join(aoi_dir, "images/L2"))
+    comp_l1_list = get_sorted_image_paths(os.path.join(aoi_dir, "composite/L1"))
+    comp_l2_list = get_sorted_image_paths(os.path.join(aoi_dir, "composite/L2"))
+    merged_list = get_sorted_image_paths(os.path.join(aoi_dir, "images/merged"), suffix=".tif")
+    stacked_list = get_sorted_image_paths(os.path.join(aoi_dir, "images/stacked"), suffix=".tif")
+    comp_merged_list = get_sorted_image_paths(os.path.join(aoi_dir, "composite/merged"), suffix=".tif")
+    close_cached_datasets()
     for image_list in (l1_list, l2_list, comp_l1_list, comp_l2_list):
         for safe_file in image_list[images_to_keep:]:
-            os.rmdir(safe_file)
+            shutil.rmtree(safe_file)
     for image_list in (merged_list, stacked_list, comp_merged_list):
         for image in image_list[images_to_keep:]:
             os.remove(image)
-            os.remove(image.rsplit('.')(0)+".msk")
+            try:
+                os.remove(image.rsplit('.', 1)[0]+".msk")
+            except FileNotFoundError:
+                pass
+
+
+def get_sorted_image_paths(directory, suffix="", recent_first=True):
+    """
+    Returns the full paths of the timestamped entries in directory ending with suffix, sorted by timestamp. The
+    directory is scanned once; entries without a Sentinel-2 timestamp are left out.
+
+    Parameters
+    ----------
+    directory : str
+        The directory to scan
+    suffix : str, optional
+        Only entries whose names end with this are returned. Defaults to "", which matches every entry.
+    recent_first : bool, optional
+        If True (the default), the first path is the most recent image. If False, the first path is the least recent.
+
+    Returns
+    -------
+    paths : list of str
+        The full paths of the matching entries, sorted by timestamp.
+
+    """
+    with os.scandir(directory) as entries:
+        paths = {entry.name: entry.path for entry in entries if entry.name.endswith(suffix)}
+    return [paths[name] for name in sort_by_timestamp(paths, recent_first=recent_first)]
 
 
 def sort_by_timestamp(strings, recent_first=True):
@@ -273,9 +355,11 @@ def sort_by_timestamp(strings, recent_first=True):
     Does not guarantee preservation of ordering of strings with the same timestamp.
 
     """
-    strings = list(filter(get_image_acquisition_time, strings))
-    strings.sort(key=lambda x: get_image_acquisition_time(x), reverse=recent_first)
-    return strings
+    # yyyymmddThhmmss timestamps sort lexically in time order, so there is no need to parse them into datetimes
+    matches = [(_SEN_2_TIMESTAMP_RE.search(string), string) for string in strings]
+    timestamped = [(match.group(0), string) for match, string in matches if match]
+    timestamped.sort(key=lambda pair: pair[0], reverse=recent_first)
+    return [string for _, string in timestamped]
 
 
 def get_change_detection_dates(image_name):
@@ -293,8 +377,7 @@ def get_change_detection_dates(image_name):
         The dates associated with the image
 
     """
-    date_regex = r"\d\d\d\d\d\d\d\dT\d\d\d\d\d\d"
-    timestamps = re.findall(date_regex, image_name)
+    timestamps = _SEN_2_TIMESTAMP_RE.findall(image_name)
     date_times = [datetime.datetime.strptime(timestamp, r"%Y%m%dT%H%M%S") for timestamp in timestamps]
     date_times.sort()
     return date_times
@@ -322,14 +405,20 @@ def get_preceding_image_path(target_image_name, search_dir):
         If there is no image older than the target image
 
     """
-    target_time = get_image_acquisition_time(target_image_name)
-    image_paths = sort_by_timestamp(os.listdir(search_dir), recent_first=True)  # Sort image list newest first
-    image_paths = filter(is_tif, image_paths)
-    for image_path in image_paths:   # Walk through newest to oldest
-        accq_time = get_image_acquisition_time(image_path)   # Get this image time
-        if accq_time < target_time:   # If this image is older than the target image, return it.
-            return os.path.join(search_dir, image_path)
-    raise FileNotFoundError("No image older than {}".format(target_image_name))
+    # Timestamps compare correctly as strings, so one pass keeping the newest image older than the target is enough
+    target_timestamp = get_sen_2_image_timestamp(target_image_name)
+    preceding_timestamp, preceding_path = None, None
+    with os.scandir(search_dir) as entries:
+        for entry in entries:
+            if not is_tif(entry.name):
+                continue
+            match = _SEN_2_TIMESTAMP_RE.search(entry.name)
+            if match and match.group(0) < target_timestamp \
+                    and (preceding_timestamp is None or match.group(0) > preceding_timestamp):
+                preceding_timestamp, preceding_path = match.group(0), entry.path
+    if preceding_path is None:
+        raise FileNotFoundError("No image older than {}".format(target_image_name))
+    return preceding_path
 
 
 def is_tif(image_string):
@@ -504,6 +593,7 @@ def get_l2_safe_file(image_name, l2_dir):
     return out[0]
 
 
+@functools.lru_cache(maxsize=8192)
 def get_sen_2_image_timestamp(image_name):
     """
     Returns the timestamps part of a Sentinel image
@@ -519,8 +609,7 @@ def get_sen_2_image_timestamp(image_name):
         The timestamp (yyyymmddThhmmss)
 
     """
-    timestamp_re = r"\d{8}T\d{6}"
-    ts_result = re.search(timestamp_re, image_name)
+    ts_result = _SEN_2_TIMESTAMP_RE.search(image_name)
     return ts_result.group(0)
 
 
@@ -565,6 +654,7 @@ def get_sen_2_baseline(image_name):
     return comps[3]
 
 
+@functools.lru_cache(maxsize=8192)
 def get_sen_2_image_tile(image_name):
     """
     Returns the tile number of a Sentinel 2 image or path
@@ -579,7 +669,7 @@ def get_sen_2_image_tile(image_name):
         The tile ID (eg: 'T13QFB')
     """
     name = os.path.basename(image_name)
-    tile = re.findall(r"T\d{2}[A-Z]{3}", name)[0]  # Matches tile ID, but not timestamp
+    tile = _SEN_2_TILE_RE.findall(name)[0]
     return tile
 
 
@@ -621,4 +711,45 @@ def get_mask_path(image_path):
     image_dir = os.path.dirname(image_path)
     mask_name = image_name.rsplit('.')[0] + ".msk"
     mask_path = os.path.join(image_dir, mask_name)
-    return mask_path
\ No newline at end of file
+    return mask_path
+
+
+def close_cached_datasets():
+    """
+    Closes the .SAFE band datasets that pyeo.raster_manipulation keeps open between calls. Call this before deleting
+    .SAFE folders that pyeo may have read: on Linux, the open files would otherwise keep using disk space, and on
+    Windows they could not be deleted. pyeo's own functions that delete .SAFE folders already call it.
+
+    """
+    # raster_manipulation imports this module, so it is looked up rather than imported; if it has not been imported,
+    # nothing has been cached
+    raster_manipulation = sys.modules.get("pyeo.raster_manipulation")
+    if raster_manipulation is not None:
+        raster_manipulation._open_cached.cache_clear()
+
+
+def prefetch_files(paths):
+    """
+    Asks the operating system to start reading each file in paths into its page cache in the background, so that a
+    later read of those files finds them already in memory. Returns immediately. Does nothing on systems without
+    posix_fadvise (eg Windows), and skips any file that cannot be opened.
+
+    Parameters
+    ----------
+    paths : iterable of str
+        Paths to the files that are about to be read
+
+    """
+    if not hasattr(os, "posix_fadvise"):
+        return
+    for path in paths:
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            continue
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
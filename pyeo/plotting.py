@@ -1,19 +1,93 @@
 """A very small plotting library."""
 
 import gdal
-from matplotlib import pyplot as plt
+import numpy as np
+from osgeo.gdal_array import GDALTypeCodeToNumericTypeCode
 import pyeo.windows_compatability
 
+# Previews are written often and thrown away; the fastest zlib level costs a little file size for a much quicker encode
+FAST_PNG_OPTIONS = ["ZLEVEL=1"]
 
-def show_satellite_image(image_path):
-    """Uses matplotlib.imshow() to preview a satellite image at image_path. Assumes image is bgr (ie quicklook)"""
+
+def show_satellite_image(image_path, max_size=2048, ax=None, image_artist=None):
+    """
+    Uses matplotlib.imshow() to preview a satellite image at image_path. Assumes image is bgr (ie quicklook).
+    Images with a side longer than max_size pixels are read shrunk to fit; gdal reads from the image's overviews if it
+    has any. Pass max_size=None to read the image at full resolution.
+
+    The image is drawn on ax, or the current axes if ax is None. To page through a series of images of the same size,
+    pass the artist returned by the first call as image_artist; its data is swapped for the new image rather than a
+    new image being added to the axes. Returns the matplotlib AxesImage showing the image.
+    """
     img = gdal.Open(image_path)
-    array = img.GetVirtualMemArray()
-    if len(array.shape) >= 3:
-        img_view = array.transpose([1,2,0])
+    width, height = _preview_size(img, max_size)
+    if img.RasterCount >= 2:
+        # imshow wants [y, x, band]; gdal reads straight into that layout through a [band, y, x] view of the buffer,
+        # so imshow gets a contiguous array instead of a transposed view of the image it would have to copy
+        img_view = np.empty((height, width, img.RasterCount),
+                            dtype=GDALTypeCodeToNumericTypeCode(img.GetRasterBand(1).DataType))
+        img.ReadAsArray(buf_obj=img_view.transpose([2, 0, 1]))
+    else:
+        img_view = img.GetRasterBand(1).ReadAsArray(buf_xsize=width, buf_ysize=height)
+    if image_artist is not None:
+        image_artist.set_data(img_view)
     else:
-        img_view = array
-    plt.imshow(img_view)
+        if ax is None:
+            # pyplot is only imported when it is needed, since importing it sets up matplotlib's (possibly
+            # interactive) backend; batch jobs that only write quicklooks never pay for that
+            from matplotlib import pyplot as plt
+            ax = plt.gca()
+        image_artist = ax.imshow(img_view)
     img_view = None
-    array = None
-    img = None
\ No newline at end of file
+    img = None
+    return image_artist
+
+
+def save_quicklook(image_path, out_path, bands=(3, 2, 1), max_size=1024, format="JPEG", creation_options=None):
+    """
+    Saves an 8-bit preview of the image at image_path to out_path without going through matplotlib; gdal reads the
+    image shrunk, stretches each band linearly between its approximate minimum and maximum and encodes the result in
+    one call.
+
+    Parameters
+    ----------
+    image_path : str
+        Path to the image to preview
+    out_path : str
+        Path to save the preview to
+    bands : tuple of int, optional
+        The bands of the image to use as red, green and blue. Defaults to (3, 2, 1); the red, green and blue bands of
+        a stack of B02, B03, B04 and B08.
+    max_size : int, optional
+        The length in pixels of the longest side of the preview. Smaller images are not enlarged. Defaults to 1024.
+    format : str, optional
+        The GDAL driver to encode the preview with. Defaults to 'JPEG'.
+    creation_options : list of str, optional
+        Driver creation options for the preview. Defaults to `FAST_PNG_OPTIONS` for PNG output and the driver defaults
+        otherwise.
+
+    """
+    img = gdal.Open(image_path)
+    width, height = _preview_size(img, max_size)
+    scale_params = []
+    for band in bands:
+        band_min, band_max = img.GetRasterBand(band).ComputeRasterMinMax(True)
+        scale_params.append([band_min, band_max, 0, 255])
+    if creation_options is None:
+        creation_options = FAST_PNG_OPTIONS if format == "PNG" else []
+    gdal.Translate(out_path, img, format=format, bandList=list(bands), width=width, height=height,
+                   resampleAlg="average", outputType=gdal.GDT_Byte, scaleParams=scale_params,
+                   creationOptions=creation_options)
+    img = None
+
+
+def _preview_size(img, max_size):
+    """
+    :meta private:
+    The width and height of img shrunk so that neither side is longer than max_size, keeping its aspect ratio.
+    """
+    width, height = img.RasterXSize, img.RasterYSize
+    if max_size and max(width, height) > max_size:
+        scale = max_size / max(width, height)
+        width, height = max(1, int(width * scale)), max(1, int(height * scale))
+    return width, height
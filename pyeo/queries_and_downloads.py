@@ -51,12 +51,19 @@ USGS, for Landsat. If in doubt, use Scihub.
 
    Landsat data is hosted and provided by the US Geological Survey. You can sign up at https://ers.cr.usgs.gov/register/
 
+Query caching
+-------------
+Results of Sentinel-2 and Planet searches can be cached on disk, so that rerunning a pipeline with the same AOI and
+dates does not hit the APIs again. Caching is off by default; set the environment variable PYEO_CACHE_DIR to a
+directory to turn it on. Pass `force_refresh=True` to :py:func:`sent2_query` to bypass the cache for one query.
+
 
 Functions
 ---------
 """
 
 import datetime as dt
+import fnmatch
 import glob
 import itertools
 import json
@@ -64,9 +71,11 @@ import logging
 import os
 import shutil
 import tarfile
+import time
 import zipfile
 from multiprocessing.dummy import Pool
 from urllib.parse import urlencode
+import joblib
 import numpy as np
 from bs4 import BeautifulSoup  # I didn't really want to use BS, but I can't see a choice.
 from tempfile import TemporaryDirectory
@@ -88,6 +97,9 @@ from pyeo.exceptions import NoL2DataAvailableException, BadDataSourceExpection,
 
 log = logging.getLogger("pyeo")
 
+# A location of None makes joblib.Memory a passthrough, so caching is opt-in
+_query_memory = joblib.Memory(location=os.environ.get("PYEO_CACHE_DIR"), verbose=0)
+
 import pyeo.windows_compatability
 
 try:
@@ -95,9 +107,14 @@ try:
 except ImportError:
     pass
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 
 
-def sent2_query(user, passwd, geojsonfile, start_date, end_date, cloud=50):
+def sent2_query(user, passwd, geojsonfile, start_date, end_date, cloud=50, force_refresh=False):
     """
     Fetches a list of Sentienl-2 products
 
@@ -125,6 +142,9 @@ def sent2_query(user, passwd, geojsonfile, start_date, end_date, cloud=50):
     cloud : int, optional
             The maximum cloud clover percentage (as calculated by Copernicus) to download. Defaults to 50%
 
+    force_refresh : bool, optional
+            If True, always query the hub even if this query is in the on-disk cache. Defaults to False.
+
     Returns
     -------
     products : dict
@@ -153,12 +173,20 @@ def sent2_query(user, passwd, geojsonfile, start_date, end_date, cloud=50):
             raise InvalidGeometryFormatException("Please provide a .json, .geojson or a .shp as geometry.")
         log.info("Sending Sentinel-2 query:\nfootprint: {}\nstart_date: {}\nend_date: {}\n cloud_cover: {} ".format(
             footprint, start_date, end_date, cloud))
-        products = api.query(footprint,
-                             date=(start_date, end_date), platformname="Sentinel-2",
-                             cloudcoverpercentage="[0 TO {}]".format(cloud))
+        if force_refresh:
+            products = _s2_api_query.func(api, footprint, start_date, end_date, cloud)
+        else:
+            products = _s2_api_query(api, footprint, start_date, end_date, cloud)
     return products
 
 
+@_query_memory.cache(ignore=["api"])
+def _s2_api_query(api, footprint, start_date, end_date, cloud):
+    return api.query(footprint,
+                     date=(start_date, end_date), platformname="Sentinel-2",
+                     cloudcoverpercentage="[0 TO {}]".format(cloud))
+
+
 def _is_4326(geom):
     proj_geom = get_vector_projection(geom)
     proj_4326 = osr.SpatialReference()
@@ -328,16 +356,15 @@ def download_landsat_data(products, out_dir, conf):
         log.info("Downloading landsat imagery from {}".format(clean_url))
         out_folder_path = os.path.join(out_dir, product['displayId'])
         os.mkdir(out_folder_path)
-        tar_path = out_folder_path + ".tar.gz"
-        with open(tar_path, 'wb+') as fp:
-            image_response = dl_session.get(clean_url)
-            fp.write(image_response.content)
-            log.info("Item {} downloaded to {}".format(product['displayId'], tar_path))
-        log.info("Unzipping {} to {}".format(tar_path, out_folder_path))
-        with tarfile.open(tar_path, 'r:gz') as tar_ref:
-            tar_ref.extractall(out_folder_path)
-        log.info("Removing {}".format(tar_path))
-        os.remove(tar_path)
+        # The archive is unpacked as it arrives rather than held in memory, written to disk and read back; the
+        # decompression and writing of each member overlaps with receiving the rest of it
+        with dl_session.get(clean_url, stream=True) as image_response:
+            image_response.raise_for_status()
+            image_response.raw.decode_content = True
+            log.info("Unzipping {} to {}".format(product['displayId'], out_folder_path))
+            with tarfile.open(fileobj=image_response.raw, mode='r|gz') as tar_ref:
+                tar_ref.extractall(out_folder_path)
+            log.info("Item {} downloaded to {}".format(product['displayId'], out_folder_path))
 
 
 def get_landsat_api_key(conf, session):
@@ -679,12 +706,16 @@ def download_s2_pairs(l1_dir, l2_dir, conf):
     # God, this is a faff.
     l1_product_list = os.listdir(l1_dir)
     l2_product_list = os.listdir(l2_dir)
+    # Each folder's products are keyed on (timestamp, tile) once, rather than the other folder being globbed again for
+    # every product, as get_l1_safe_file and get_l2_safe_file would
+    l1_keys = _safe_product_keys(l1_product_list, "MSIL1C")
+    l2_keys = _safe_product_keys(l2_product_list, "MSIL2A")
     missing_products = []
     for l1_prod in l1_product_list:
-        if not fu.get_l2_safe_file(l1_prod, l2_dir):
+        if _safe_product_key(l1_prod) not in l2_keys:
             missing_products.append(l1_prod)
     for l2_prod in l2_product_list:
-        if not fu.get_l1_safe_file(l2_prod, l1_dir):
+        if _safe_product_key(l2_prod) not in l1_keys:
             missing_products.append(l2_prod)
     to_download = {}
     log.info("{} missing products: {}".format(len(missing_products), missing_products))
@@ -695,6 +726,24 @@ def download_s2_pairs(l1_dir, l2_dir, conf):
     download_s2_data(to_download, l1_dir, l2_dir, user=conf['sent_2']['user'], passwd=conf['sent_2']['pass'])
 
 
+def _safe_product_key(product_name):
+    """
+    :meta private:
+    The (timestamp, tile) pair that pairs up the L1 and L2 .SAFE files of the same image.
+    """
+    return fu.get_sen_2_image_timestamp(product_name), get_sen_2_image_tile(product_name)
+
+
+def _safe_product_keys(product_names, product_type):
+    """
+    :meta private:
+    The set of :py:func:`_safe_product_key` pairs of the product_type .SAFE files in product_names; the same files
+    the glob in :py:func:`pyeo.filesystem_utilities.get_l1_safe_file` and `get_l2_safe_file` matches.
+    """
+    safe_pattern = "S2[A|B]_{}_*.SAFE".format(product_type)
+    return {_safe_product_key(name) for name in product_names if fnmatch.fnmatchcase(name, safe_pattern)}
+
+
 def query_for_corresponding_image(prod,conf):
     """
     Queries Copernicus Hub for the corresponding l1/l2 image to 'prod'
@@ -818,6 +867,7 @@ def download_from_google_cloud(product_ids, out_folder, redownload=False):
             return
         if redownload:
             log.info("Removing {}".format(os.path.join(out_folder, safe_id)))
+            fu.close_cached_datasets()
             shutil.rmtree(os.path.join(out_folder, safe_id))
         tile_id = get_sen_2_image_tile(safe_id)
         utm_zone = tile_id[1:3]
@@ -833,11 +883,8 @@ def download_from_google_cloud(product_ids, out_folder, redownload=False):
         for s2_object in object_iter:
             download_blob_from_google(bucket, object_prefix, out_folder, s2_object)
         # Need to make these two empty folders for sen2cor to work properly
-        try:
-            os.mkdir(os.path.join(os.path.abspath(out_folder), safe_id, "AUX_DATA"))
-            os.mkdir(os.path.join(os.path.abspath(out_folder), safe_id, "HTML"))
-        except FileExistsError:
-            pass
+        for empty_folder in ("AUX_DATA", "HTML"):
+            os.makedirs(os.path.join(os.path.abspath(out_folder), safe_id, empty_folder), exist_ok=True)
 
 
 def download_blob_from_google(bucket, object_prefix, out_folder, s2_object):
@@ -967,9 +1014,14 @@ def do_quick_search(session, search_request):
     :meta private:
     Tries the quick search; returns a dict of features
     """
-    search_url = "https://api.planet.com/data/v1/quick-search"
     search_request.pop("name")
-    print("Sending quick search")
+    return _post_quick_search(session, search_request)
+
+
+@_query_memory.cache(ignore=["session"])
+def _post_quick_search(session, search_request):
+    search_url = "https://api.planet.com/data/v1/quick-search"
+    log.info("Sending quick search")
     search_result = session.post(search_url, json=search_request)
     if search_result.status_code >= 400:
         raise requests.ConnectionError
@@ -1020,6 +1072,7 @@ def activate_and_dl_planet_item(session, item, asset_type, file_path):
     item_response = session.get(item_url)
     log.info("Activating " + item_id)
     activate_response = session.post(item_response.json()[asset_type]["_links"]["activate"])
+    backoff = 1
     while True:
         status = session.get(item_url)
         if status.status_code == 429:
@@ -1027,15 +1080,21 @@ def activate_and_dl_planet_item(session, item, asset_type, file_path):
             raise TooManyRequests
         if status.json()[asset_type]["status"] == "active":
             break
+        # Activation takes minutes; sleep between polls instead of hammering the API
+        time.sleep(backoff)
+        backoff = min(backoff*2, 30)
     dl_link = status.json()[asset_type]["location"]
     item_fp = os.path.join(file_path, item_id + ".tif")
     log.info("Downloading item {} from {} to {}".format(item_id, dl_link, item_fp))
     # TODO Do we want the metadata in a separate file as well as embedded in the geotiff?
-    with open(item_fp, 'wb+') as fp:
-        image_response = session.get(dl_link)
+    with session.get(dl_link, stream=True) as image_response:
         if image_response.status_code == 429:
             raise TooManyRequests
-        fp.write(image_response.content)  # Don't like this; it might store the image twice. Check.
+        image_response.raise_for_status()
+        # Undo any Content-Encoding, as iter_content did, rather than writing the compressed bytes to item_fp
+        image_response.raw.decode_content = True
+        with open(item_fp, 'wb') as fp:
+            shutil.copyfileobj(image_response.raw, fp, length=1024*1024)
         log.info("Item {} download complete".format(item_id))
 
 
@@ -1053,8 +1112,13 @@ def read_aoi(aoi_path):
         A dictionary translation of the feature inside the .json file
 
     """
-    with open(aoi_path, 'r') as aoi_fp:
-        aoi_dict = json.load(aoi_fp)
-        if aoi_dict["type"] == "FeatureCollection":
-            aoi_dict = aoi_dict["features"][0]
-        return aoi_dict
+    # orjson is optional, but parses large geojsons several times faster than the standard library when present
+    if orjson:
+        with open(aoi_path, 'rb') as aoi_fp:
+            aoi_dict = orjson.loads(aoi_fp.read())
+    else:
+        with open(aoi_path, 'r') as aoi_fp:
+            aoi_dict = json.load(aoi_fp)
+    if aoi_dict["type"] == "FeatureCollection":
+        aoi_dict = aoi_dict["features"][0]
+    return aoi_dict
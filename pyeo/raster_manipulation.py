@@ -114,42 +114,149 @@ Function reference
 """
 import sys
 import datetime
+import fnmatch
+import functools
 import glob
 import logging
 import os
 import shutil
 import subprocess
 import re
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from tempfile import TemporaryDirectory, NamedTemporaryFile
 
 import gdal
 import numpy as np
+from joblib import Parallel, cpu_count, delayed, effective_n_jobs
 from osgeo import gdal_array, osr, ogr
 from osgeo.gdal_array import NumericTypeCodeToGDALTypeCode, GDALTypeCodeToNumericTypeCode
 from skimage import morphology as morph
 
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+
 import pdb
 import faulthandler
 
 from pyeo.coordinate_manipulation import get_combined_polygon, pixel_bounds_from_polygon, write_geometry, \
     get_aoi_intersection, get_raster_bounds, align_bounds_to_whole_number, get_poly_bounding_rect, reproject_vector, \
-    get_local_top_left
-from pyeo.array_utilities import project_array
+    get_local_top_left, epsg_to_wkt
+from pyeo.array_utilities import project_array_view
 from pyeo.filesystem_utilities import sort_by_timestamp, get_sen_2_tiles, get_l1_safe_file, get_sen_2_image_timestamp, \
     get_sen_2_image_tile, get_sen_2_granule_id, check_for_invalid_l2_data, get_mask_path, get_sen_2_baseline, \
-    get_safe_product_type
+    get_safe_product_type, get_sorted_image_paths, get_safe_dirs, close_cached_datasets
 from pyeo.exceptions import CreateNewStacksException, StackImagesException, BadS2Exception, NonSquarePixelException
 
 log = logging.getLogger("pyeo")
 
+# SAFE folders hold hundreds of files; stop gdal listing the directory for sidecars on every Open (TRUE still probes
+# for .aux.xml, .ovr and .msk files one by one, unlike EMPTY_DIR), give the block cache enough room for full S2
+# tiles, and let the JPEG2000 driver decode S2 bands' code blocks on every core.
+# Each can be overridden per machine from the environment.
+gdal.SetConfigOption("GDAL_DISABLE_READDIR_ON_OPEN", os.environ.get("GDAL_DISABLE_READDIR_ON_OPEN", "TRUE"))
+if "GDAL_CACHEMAX" not in os.environ:
+    # GDAL's default cache is 5% of RAM, which on large machines is already bigger than this; only ever raise it
+    _cachemax_bytes = int(os.environ.get("PYEO_GDAL_CACHEMAX", "1024")) * 1024 * 1024
+    if gdal.GetCacheMax() < _cachemax_bytes:
+        gdal.SetCacheMax(_cachemax_bytes)
+gdal.SetConfigOption("GDAL_NUM_THREADS", os.environ.get("GDAL_NUM_THREADS", "ALL_CPUS"))
+gdal.SetConfigOption("VSI_CACHE", os.environ.get("VSI_CACHE", "TRUE"))
+gdal.SetConfigOption("CPL_VSIL_CURL_ALLOWED_EXTENSIONS",
+                     os.environ.get("CPL_VSIL_CURL_ALLOWED_EXTENSIONS", ".tif,.jp2,.xml"))
+
+# Creation options for large GTiff outputs that are written once and then read in windows
+TILED_GTIFF_OPTIONS = ["TILED=YES", "BLOCKXSIZE=512", "BLOCKYSIZE=512", "COMPRESS=DEFLATE", "PREDICTOR=2",
+                       "NUM_THREADS=ALL_CPUS", "BIGTIFF=IF_SAFER"]
+# Creation options for GTiffs that are created empty and then filled in place. These are left uncompressed, since
+# rewriting a compressed tile that has already been written appends a new copy of it to the file.
+TILED_UPDATE_GTIFF_OPTIONS = ["TILED=YES", "BLOCKXSIZE=512", "BLOCKYSIZE=512", "BIGTIFF=IF_SAFER"]
+
+
+def _tiled_gtiff_options():
+    """
+    :meta private:
+    TILED_GTIFF_OPTIONS, compressing with GDAL_NUM_THREADS threads rather than every core, so that worker processes
+    that have been given a share of the cores keep to it.
+    """
+    num_threads = gdal.GetConfigOption("GDAL_NUM_THREADS", "ALL_CPUS")
+    return [option for option in TILED_GTIFF_OPTIONS if not option.startswith("NUM_THREADS=")] + \
+           ["NUM_THREADS=" + num_threads]
+
 import pyeo.windows_compatability
 faulthandler.enable()
 
 
 
 
+def _open_read_only(path):
+    """
+    :meta private:
+    Opens a raster that is only going to be read, reusing a dataset already opened for the same unchanged file.
+    Only use this for inputs that pyeo never modifies, such as the bands in a .SAFE file; the cached dataset keeps the
+    file open. Anything that deletes .SAFE folders must call :py:func:`pyeo.filesystem_utilities.close_cached_datasets`
+    first.
+    """
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:  # /vsi paths and the like; let gdal deal with them
+        return gdal.Open(path)
+    return _open_cached(path, mtime)
+
+
+@functools.lru_cache(maxsize=64)
+def _open_cached(path, mtime):
+    """:meta private:"""
+    return gdal.OpenEx(path, gdal.OF_READONLY | gdal.OF_RASTER)
+
+
+def _open_raster(raster):
+    """
+    :meta private:
+    Returns raster unchanged if it is already an open gdal dataset, otherwise opens the path with gdal.Open, so that
+    functions reading a list of inputs can be passed either paths or the datasets from an earlier stage. Paths are
+    not cached with `_open_read_only`, since these inputs are often intermediate files that are about to be removed.
+    """
+    if hasattr(raster, "GetGeoTransform"):
+        return raster
+    return gdal.Open(raster)
+
+
+def _row_windows(raster, min_rows=256):
+    """
+    :meta private:
+    Yields (y_offset, n_rows) strips covering the full height of raster, a whole number of its blocks high, so that
+    large rasters can be processed without holding them in memory at once.
+    """
+    block_rows = raster.GetRasterBand(1).GetBlockSize()[1]
+    step = block_rows * max(1, min_rows // block_rows)
+    for y_offset in range(0, raster.RasterYSize, step):
+        yield y_offset, min(step, raster.RasterYSize - y_offset)
+
+
+def _read_window(raster, x_offset, y_offset, x_size, y_size):
+    """
+    :meta private:
+    Reads a window from every band of raster as a [band, y, x] array, even for single-band rasters.
+    """
+    window = raster.ReadAsArray(x_offset, y_offset, x_size, y_size)
+    if window.ndim == 2:
+        window = np.expand_dims(window, 0)
+    return window
+
+
+def _write_window(raster, window, x_offset, y_offset):
+    """
+    :meta private:
+    Writes a [band, y, x] array into raster with its top-left corner at (x_offset, y_offset).
+    """
+    for band_index, band_array in enumerate(window):
+        raster.GetRasterBand(band_index + 1).WriteArray(band_array, x_offset, y_offset)
+
+
 def create_matching_dataset(in_dataset, out_path,
-                            format="GTiff", bands=1, datatype = None):
+                            format="GTiff", bands=1, datatype = None, options=None):
     """
     Creates an empty gdal dataset with the same dimensions, projection and geotransform as in_dataset.
     Defaults to 1 band.
@@ -168,6 +275,8 @@ def create_matching_dataset(in_dataset, out_path,
     datatype : gdal constant, optional
         The datatype of the returned dataset. See the introduction for this module. Defaults to in_dataset's datatype
         if not supplied.
+    options : list of str, optional
+        Driver creation options, eg `TILED_GTIFF_OPTIONS`. Defaults to the driver's defaults.
 
     Returns
     -------
@@ -182,7 +291,8 @@ def create_matching_dataset(in_dataset, out_path,
                                 xsize=in_dataset.RasterXSize,
                                 ysize=in_dataset.RasterYSize,
                                 bands=bands,
-                                eType=datatype)
+                                eType=datatype,
+                                options=options or [])
     out_dataset.SetGeoTransform(in_dataset.GetGeoTransform())
     out_dataset.SetProjection(in_dataset.GetProjection())
     return out_dataset
@@ -233,7 +343,7 @@ def save_array_as_image(array, path, geotransform, projection, format = "GTiff")
     return path
 
 
-def create_new_stacks(image_dir, stack_dir):
+def create_new_stacks(image_dir, stack_dir, n_jobs=-1):
     """
     For each granule present in image_dir Saves the result in stacked_dir.
     Assumes that each image in image_dir is saved with a Sentinel-2 identifiter name - see merge_raster.
@@ -244,6 +354,9 @@ def create_new_stacks(image_dir, stack_dir):
         A path to the directory containing the images to be stacked, all named as Sentinel 2 identifiers
     stack_dir : str
         A path to a directory to save the stacked images to.
+    n_jobs : int, optional
+        The number of pairs of images to stack at once. Defaults to -1 (one per core). The cores are shared out
+        between the workers for compression.
     Returns
     -------
     new_stacks : list of str
@@ -262,7 +375,7 @@ def create_new_stacks(image_dir, stack_dir):
         If the image directory is empty
 
     """
-    new_images = []
+    image_pairs = []
     tiles = get_sen_2_tiles(image_dir)
     tiles = list(set(tiles)) # eliminate duplicates
     n_tiles = len(tiles)
@@ -283,11 +396,25 @@ def create_new_stacks(image_dir, stack_dir):
             # and repeat
             latest_image_path = safe_files[0]
             for image in safe_files[1:]:
-                new_images.append(stack_old_and_new_images(image, latest_image_path, stack_dir))
+                image_pairs.append((image, latest_image_path))
                 latest_image_path = image
+    # Every pair is written to its own stack and only reads its two images, so the pairs can be stacked in separate
+    # processes. Each worker compresses with its share of the cores rather than a thread per core.
+    n_workers = max(1, min(effective_n_jobs(n_jobs), len(image_pairs)))
+    gdal_threads = max(1, cpu_count() // n_workers)
+    new_images = Parallel(n_jobs=n_jobs, backend="loky", batch_size=1)(
+        delayed(_stack_image_pair)(image, latest_image_path, stack_dir, gdal_threads)
+        for image, latest_image_path in image_pairs)
     return new_images
 
 
+def _stack_image_pair(old_image_path, new_image_path, out_dir, gdal_threads=None):
+    """Stacks a single pair of images for :py:func:`create_new_stacks`"""
+    if gdal_threads and "GDAL_NUM_THREADS" not in os.environ:
+        gdal.SetConfigOption("GDAL_NUM_THREADS", str(gdal_threads))
+    return stack_old_and_new_images(old_image_path, new_image_path, out_dir)
+
+
 def stack_image_with_composite(image_path, composite_path, out_dir, create_combined_mask=True, skip_if_exists=True,
                                invert_stack = False):
     """
@@ -328,19 +455,32 @@ def stack_image_with_composite(image_path, composite_path, out_dir, create_combi
     if os.path.exists(out_path) and os.path.exists(out_mask_path) and skip_if_exists:
         log.info("{} and mask exists, skipping".format(out_path))
         return out_path
+    if create_combined_mask:
+        image_mask_path = get_mask_path(image_path)
+        comp_mask_path = get_mask_path(composite_path)
+        _check_masks_exist([comp_mask_path, image_mask_path])
     to_be_stacked = [composite_path, image_path]
     if invert_stack:
         to_be_stacked.reverse()
     stack_images(to_be_stacked, out_path, geometry_mode="intersect")
     if create_combined_mask:
-        image_mask_path = get_mask_path(image_path)
-        comp_mask_path = get_mask_path(composite_path)
         combine_masks([comp_mask_path, image_mask_path], out_mask_path, combination_func="and", geometry_func="intersect")
     return out_path
 
 
+def _check_masks_exist(mask_paths):
+    """
+    :meta private:
+    Raises FileNotFoundError for the first of mask_paths that doesn't exist, so that functions that stack images and
+    then combine their masks fail before the stack is written rather than after.
+    """
+    for mask_path in mask_paths:
+        if not os.path.exists(mask_path):
+            raise FileNotFoundError("Mask not found at {}".format(mask_path))
+
+
 def stack_images(raster_paths, out_raster_path,
-                 geometry_mode="intersect", format="GTiff", datatype=gdal.GDT_Int32):
+                 geometry_mode="intersect", format="GTiff", datatype=gdal.GDT_Int32, creation_options=None):
     """
     When provided with a list of rasters, will stack them into a single raster. The nunmber of
     bands in the output is equal to the total number of bands in the input. Geotransform and projection
@@ -349,8 +489,8 @@ def stack_images(raster_paths, out_raster_path,
 
     Parameters
     ----------
-    raster_paths : list of str
-        A list of paths to the rasters to be stacked, in order.
+    raster_paths : list of str or gdal.Dataset
+        A list of paths to the rasters to be stacked, in order. Already-open datasets may be passed instead.
     out_raster_path : str
         The path to the saved output raster.
     geometry_mode : {'intersect' or 'union'}
@@ -361,54 +501,52 @@ def stack_images(raster_paths, out_raster_path,
     format : str, optional
         The GDAL image format for the output. Defaults to 'GTiff'
     datatype : gdal datatype, optional
-        The datatype of the gdal array - see introduction. Defaults to gdal.GDT_Int32.
+        The datatype of the gdal array - see introduction. Defaults to gdal.GDT_Int32. If None, uses the datatype
+        of the first band of the first raster.
+    creation_options : list of str, optional
+        Driver creation options for the output. Defaults to `TILED_GTIFF_OPTIONS` for GTiff output and the driver
+        defaults otherwise.
 
     """
     #TODO: Confirm the union works, and confirm that nondata defaults to 0.
     log.info("Stacking images {}".format(raster_paths))
     if len(raster_paths) <= 1:
         raise StackImagesException("stack_images requires at least two input images")
-    rasters = [gdal.Open(raster_path) for raster_path in raster_paths]
-    total_layers = sum(raster.RasterCount for raster in rasters)
-    projection = rasters[0].GetProjection()
+    rasters = [_open_raster(raster_path) for raster_path in raster_paths]
     in_gt = rasters[0].GetGeoTransform()
     x_res = in_gt[1]
     y_res = in_gt[5]*-1   # Y resolution in affine geotransform is -ve for Maths reasons
+    if datatype is None:
+        datatype = rasters[0].GetRasterBand(1).DataType
+    if creation_options is None:
+        creation_options = _tiled_gtiff_options() if format == "GTiff" else []
     combined_polygons = get_combined_polygon(rasters, geometry_mode)
 
-    # Creating a new gdal object
-    out_raster = create_new_image_from_polygon(combined_polygons, out_raster_path, x_res, y_res,
-                                               total_layers, projection, format, datatype)
+    # Same output grid as create_new_image_from_polygon; width and height are truncated to whole pixels
+    x_min, x_max, y_min, y_max = combined_polygons.GetEnvelope()
+    width = int(np.abs(x_max - x_min) / x_res)
+    height = int(np.abs(y_max - y_min) / y_res)
+    out_bounds = (x_min, y_max - height*y_res, x_min + width*x_res, y_max)
 
-    # I've done some magic here. GetVirtualMemArray lets you change a raster directly without copying
-    out_raster_array = out_raster.GetVirtualMemArray(eAccess=gdal.GF_Write)
-    present_layer = 0
-    for i, in_raster in enumerate(rasters):
-        log.info("Stacking image {}".format(i))
-        in_raster_array = in_raster.GetVirtualMemArray()
-        out_x_min, out_x_max, out_y_min, out_y_max = pixel_bounds_from_polygon(out_raster, combined_polygons)
-        in_x_min, in_x_max, in_y_min, in_y_max = pixel_bounds_from_polygon(in_raster, combined_polygons)
-        if len(in_raster_array.shape) == 2:
-            in_raster_array = np.expand_dims(in_raster_array, 0)
-        # Gdal does band, y, x
-        out_raster_view = out_raster_array[
-                      present_layer:  present_layer + in_raster.RasterCount,
-                      out_y_min: out_y_max,
-                      out_x_min: out_x_max
-                      ]
-        in_raster_view = in_raster_array[
-                    0:in_raster.RasterCount,
-                    in_y_min: in_y_max,
-                    in_x_min: in_x_max
-                    ]
-        out_raster_view[...] = in_raster_view
-        out_raster_view = None
-        in_raster_view = None
-        present_layer += in_raster.RasterCount
-        in_raster_array = None
-        in_raster = None
-    out_raster_array = None
-    out_raster = None
+    # Rather than copying each array by hand, we build a virtual raster with one layer per input band and let
+    # gdal write it out in one pass. BuildVRT only takes the first band of each source when separate=True, so each
+    # band gets its own single-band VRT first.
+    with TemporaryDirectory() as td:
+        band_paths = []
+        for i, in_raster in enumerate(rasters):
+            log.info("Stacking image {}".format(i))
+            for band in range(1, in_raster.RasterCount + 1):
+                band_path = os.path.join(td, "{}_{}.vrt".format(i, band))
+                gdal.Translate(band_path, in_raster, format="VRT", bandList=[band])
+                band_paths.append(band_path)
+        stack_vrt = gdal.BuildVRT(os.path.join(td, "stack.vrt"), band_paths, separate=True,
+                                  resolution="user", xRes=x_res, yRes=y_res, outputBounds=out_bounds,
+                                  resampleAlg="nearest", srcNodata="None", VRTNodata="None")
+        out_raster = gdal.Translate(out_raster_path, stack_vrt, format=format, outputType=datatype,
+                                    creationOptions=creation_options)
+        out_raster = None
+        stack_vrt = None
+    rasters = None
 
 
 def strip_bands(in_raster_path, out_raster_path, bands_to_strip):
@@ -458,8 +596,8 @@ def average_images(raster_paths, out_raster_path,
 
     Parameters
     ----------
-    raster_paths : list of str
-        A list of paths to the rasters to be stacked, in order.
+    raster_paths : list of str or gdal.Dataset
+        A list of paths to the rasters to be stacked, in order. Already-open datasets may be passed instead.
     out_raster_path : str
         The path to the saved output raster.
     geometry_mode : {'intersect' or 'union'}, optional
@@ -477,7 +615,7 @@ def average_images(raster_paths, out_raster_path,
     log.info("Stacking images {}".format(raster_paths))
     if len(raster_paths) <= 1:
         raise StackImagesException("stack_images requires at least two input images")
-    rasters = [gdal.Open(raster_path) for raster_path in raster_paths]
+    rasters = [_open_raster(raster_path) for raster_path in raster_paths]
     most_rasters = max(raster.RasterCount for raster in rasters)
     projection = rasters[0].GetProjection()
     in_gt = rasters[0].GetGeoTransform()
@@ -494,10 +632,11 @@ def average_images(raster_paths, out_raster_path,
     if len(out_raster_array.shape == 2):
         out_raster_array = np.expand_dims(out_raster_array, 3)
     present_layer = 0
+    # Every input is averaged into the same window of the output, so its bounds are only worked out once
+    out_x_min, out_x_max, out_y_min, out_y_max = pixel_bounds_from_polygon(out_raster, combined_polygons)
     for i, in_raster in enumerate(rasters):
         log.info("Stacking image {}".format(i))
         in_raster_array = in_raster.GetVirtualMemArray()
-        out_x_min, out_x_max, out_y_min, out_y_max = pixel_bounds_from_polygon(out_raster, combined_polygons)
         in_x_min, in_x_max, in_y_min, in_y_max = pixel_bounds_from_polygon(in_raster, combined_polygons)
         if len(in_raster_array.shape) == 2:
             in_raster_array = np.expand_dims(in_raster_array, 0)
@@ -570,7 +709,7 @@ def trim_image(in_raster_path, out_raster_path, polygon, format="GTiff"):
         in_raster = None
 
 
-def mosaic_images(raster_paths, out_raster_file, format="GTiff", datatype=gdal.GDT_Int32, nodata = 0):
+def mosaic_images(raster_paths, out_raster_file, format="GTiff", datatype=gdal.GDT_Int32, nodata = 0, use_vrt=True):
     """
     Mosaics multiple images with the same number of layers into one single image. Overwrites
     overlapping pixels with the value furthest down raster_paths. Takes projection from the first
@@ -578,8 +717,8 @@ def mosaic_images(raster_paths, out_raster_file, format="GTiff", datatype=gdal.G
 
     Parameters
     ----------
-    raster_paths : str
-        A list of paths of raster to be mosaiced
+    raster_paths : list of str or gdal.Dataset
+        A list of paths of raster to be mosaiced. Already-open datasets may be passed instead.
     out_raster_file : str
         The path to the output file
     format : str
@@ -588,36 +727,81 @@ def mosaic_images(raster_paths, out_raster_file, format="GTiff", datatype=gdal.G
         The datatype of the output raster. Defaults to gdal.GDT_Int32
     nodata : number
         The input nodata value; any pixels in raster_paths with this value will be ignored. Defaults to 0.
+    use_vrt : bool, optional
+        If True (the default), the mosaic is built as a virtual raster and written out by gdal in one pass. If False,
+        each raster is copied into the output a strip at a time in numpy.
 
     """
 
     # This, again, is very similar to stack_rasters
     log = logging.getLogger(__name__)
     log.info("Beginning mosaic")
-    rasters = [gdal.Open(raster_path) for raster_path in raster_paths]
+    rasters = [_open_raster(raster_path) for raster_path in raster_paths]
     projection = rasters[0].GetProjection()
     in_gt = rasters[0].GetGeoTransform()
     x_res = in_gt[1]
     y_res = in_gt[5] * -1  # Y resolution in agt is -ve for Maths reasons
     combined_polygon = align_bounds_to_whole_number(get_combined_polygon(rasters, geometry_mode='union'))
+    if use_vrt:
+        # Later VRT sources are drawn over earlier ones except where they hold srcNodata, which is exactly
+        # "furthest down raster_paths wins". Uses the same output grid as create_new_image_from_polygon.
+        x_min, x_max, y_min, y_max = combined_polygon.GetEnvelope()
+        width = int(np.abs(x_max - x_min) / x_res)
+        height = int(np.abs(y_max - y_min) / y_res)
+        out_bounds = (x_min, y_max - height*y_res, x_min + width*x_res, y_max)
+        creation_options = _tiled_gtiff_options() if format == "GTiff" else []
+        with TemporaryDirectory() as td:
+            mosaic_vrt = gdal.BuildVRT(os.path.join(td, "mosaic.vrt"), rasters,
+                                       resolution="user", xRes=x_res, yRes=y_res, outputBounds=out_bounds,
+                                       resampleAlg="nearest", srcNodata=nodata, VRTNodata="None")
+            out_raster = gdal.Translate(out_raster_file, mosaic_vrt, format=format, outputType=datatype,
+                                        outputSRS=projection, creationOptions=creation_options)
+            out_raster = None
+            mosaic_vrt = None
+        rasters = None
+        log.info("Raster mosaicking done")
+        return
     layers = rasters[0].RasterCount
     out_raster = create_new_image_from_polygon(combined_polygon, out_raster_file, x_res, y_res, layers,
                                                projection, format, datatype)
     log.info("New empty image created at {}".format(out_raster_file))
-    out_raster_array = out_raster.GetVirtualMemArray(eAccess=gdal.GF_Write)
-    for i, raster in enumerate(rasters):
-        log.info("Now mosaicking raster no. {}".format(i))
-        in_raster_array = raster.GetVirtualMemArray()
-        if len(in_raster_array.shape) == 2:
-            in_raster_array = np.expand_dims(in_raster_array, 0)
-        in_bounds = get_raster_bounds(raster)
-        out_x_min, out_x_max, out_y_min, out_y_max = pixel_bounds_from_polygon(out_raster, in_bounds)
-        out_raster_view = out_raster_array[:, out_y_min: out_y_max, out_x_min: out_x_max]
-        np.copyto(out_raster_view, in_raster_array, where=in_raster_array != nodata)
-        in_raster_array = None
-        out_raster_view = None
+    # Works through the output a strip at a time, so neither the inputs nor the output need to fit in memory. Within
+    # each strip the inputs are taken from the last back to the first, with each output pixel only written by the
+    # first valid input to reach it; `filled` records which pixels of the strip have been written, so inputs whose
+    # part of the strip is already fully written need not be read at all.
+    placements = []
+    for raster in rasters:
+        out_x_min, out_x_max, out_y_min, out_y_max = pixel_bounds_from_polygon(out_raster, get_raster_bounds(raster))
+        width = min(raster.RasterXSize, out_raster.RasterXSize - out_x_min)
+        height = min(raster.RasterYSize, out_raster.RasterYSize - out_y_min)
+        placements.append((out_x_min, out_y_min, width, height))
+    valid_buffer = None
+    for y_offset, rows in _row_windows(out_raster):
+        out_window = _read_window(out_raster, 0, y_offset, out_raster.RasterXSize, rows)
+        filled = np.zeros(out_window.shape, dtype=bool)
+        for i in reversed(range(len(rasters))):
+            out_x_min, out_y_min, width, height = placements[i]
+            # The rows of this strip that rasters[i] covers, in output coordinates
+            top = max(y_offset, out_y_min)
+            bottom = min(y_offset + rows, out_y_min + height)
+            if bottom <= top or width <= 0:
+                continue
+            strip_rows = slice(top - y_offset, bottom - y_offset)
+            strip_cols = slice(out_x_min, out_x_min + width)
+            filled_window = filled[:, strip_rows, strip_cols]
+            if filled_window.all():
+                continue
+            in_window = _read_window(rasters[i], 0, top - out_y_min, width, bottom - top)
+            # The valid-pixel mask goes into a buffer kept across strips instead of a fresh bool array each time
+            if valid_buffer is None or valid_buffer.shape != in_window.shape:
+                valid_buffer = np.empty(in_window.shape, dtype=bool)
+            np.not_equal(in_window, nodata, out=valid_buffer)
+            np.greater(valid_buffer, filled_window, out=valid_buffer)  # valid and not yet filled
+            np.copyto(out_window[:, strip_rows, strip_cols], in_window, where=valid_buffer)
+            filled_window |= valid_buffer
+        _write_window(out_raster, out_window, 0, y_offset)
     log.info("Raster mosaicking done")
-    out_raster_array = None
+    out_raster = None
 
 
 def composite_images_with_mask(in_raster_path_list, composite_out_path, format="GTiff", generate_date_image=False):
@@ -677,42 +861,60 @@ def composite_images_with_mask(in_raster_path_list, composite_out_path, format="
     if generate_date_image:
         time_out_path = composite_out_path.rsplit('.')[0]+".dates"
         dates_image = create_matching_dataset(composite_image, time_out_path, bands=1, datatype=gdal.GDT_UInt32)
-        dates_array = dates_image.GetVirtualMemArray(eAccess=gdal.gdalconst.GF_Write).squeeze()
 
-    output_array = composite_image.GetVirtualMemArray(eAccess=gdal.gdalconst.GF_Write)
-    if len(output_array.shape) == 2:
-        output_array = np.expand_dims(output_array, 0)
+    mask_paths = [get_mask_path(in_raster_path) for in_raster_path in in_raster_path_list]
 
-    mask_paths = []
-
-    for i, in_raster in enumerate(in_raster_list):
-        mask_paths.append(get_mask_path(in_raster_path_list[i]))
-
-        # Get a view of in_raster according to output_array
+    # The later an image is in in_raster_path_list, the higher its priority, so the images are worked through from
+    # the last back to the first and each composite pixel is only written by the first clear image to reach it.
+    # `filled` records which pixels have been written, so strips whose pixels are all already filled are skipped
+    # without reading the image or its mask at all.
+    filled = np.zeros((composite_image.RasterYSize, composite_image.RasterXSize), dtype=bool)
+    for i, in_raster in reversed(list(enumerate(in_raster_list))):
+        # Get the window of composite_image that in_raster covers
         log.info("Adding {} to composite".format(in_raster_path_list[i]))
         in_bounds = align_bounds_to_whole_number(get_raster_bounds(in_raster))
         x_min, x_max, y_min, y_max = pixel_bounds_from_polygon(composite_image, in_bounds)
-        output_view = output_array[:, y_min:y_max, x_min:x_max]
-
-        # Move every unmasked pixel in in_raster to output_view
+        width = min(in_raster.RasterXSize, composite_image.RasterXSize - x_min)
         log.info("Mask for {} at {}".format(in_raster_path_list[i], mask_paths[i]))
-        in_masked = get_masked_array(in_raster, mask_paths[i])
-        np.copyto(output_view, in_masked, where=np.logical_not(in_masked.mask))
-
-        # Save dates in date_image if needed
+        mask = gdal.Open(mask_paths[i])
         if generate_date_image:
-            dates_view = dates_array[y_min: y_max, x_min: x_max]
             # Gets timestamp as integer in form yyyymmdd
             date = np.uint32(get_sen_2_image_timestamp(in_raster.GetFileList()[0]).split("T")[0])
-            dates_view[np.logical_not(in_masked.mask[0, ...])] = date
-            dates_view = None
+
+        # Move every unmasked pixel in in_raster to the composite, a strip at a time so that neither the inputs nor
+        # the composite need to fit in memory. The mask strip and the clear-pixel flags are read and computed into
+        # buffers that are reused for every strip.
+        mask_band = mask.GetRasterBand(1)
+        strip_rows = next(_row_windows(in_raster))[1]
+        mask_buffer = np.empty((strip_rows, width), dtype=GDALTypeCodeToNumericTypeCode(mask_band.DataType))
+        clear_buffer = np.empty((strip_rows, width), dtype=bool)
+        for y_offset, rows in _row_windows(in_raster):
+            rows = min(rows, composite_image.RasterYSize - y_min - y_offset)
+            if rows <= 0:
+                break
+            filled_window = filled[y_min + y_offset: y_min + y_offset + rows, x_min: x_min + width]
+            if filled_window.all():
+                continue
+            in_window = _read_window(in_raster, 0, y_offset, width, rows)
+            mask_window = mask_band.ReadAsArray(0, y_offset, width, rows, buf_obj=mask_buffer[:rows])
+            clear = np.not_equal(mask_window, 0, out=clear_buffer[:rows])  # Mask is multiplicative
+            np.greater(clear, filled_window, out=clear)  # clear and not yet filled, without a temporary
+            filled_window |= clear
+            output_window = _read_window(composite_image, x_min, y_min + y_offset, width, rows)
+            np.copyto(output_window, in_window, where=clear)
+            _write_window(composite_image, output_window, x_min, y_min + y_offset)
+
+            # Save dates in date_image if needed
+            if generate_date_image:
+                dates_window = _read_window(dates_image, x_min, y_min + y_offset, width, rows)
+                np.copyto(dates_window, date, where=clear)
+                _write_window(dates_image, dates_window, x_min, y_min + y_offset)
 
         # Deallocate
-        output_view = None
-        in_masked = None
+        mask_band = None
+        mask = None
 
-    output_array = None
-    dates_array = None
+    filled = None
     dates_image = None
     composite_image = None
 
@@ -722,7 +924,7 @@ def composite_images_with_mask(in_raster_path_list, composite_out_path, format="
     return composite_out_path
 
 
-def reproject_directory(in_dir, out_dir, new_projection, extension = '.tif'):
+def reproject_directory(in_dir, out_dir, new_projection, extension = '.tif', n_jobs=-1, skip_existing=False):
     """
     Reprojects every file ending with extension to new_projection and saves in out_dir
 
@@ -737,14 +939,56 @@ def reproject_directory(in_dir, out_dir, new_projection, extension = '.tif'):
         The new projection in wkt.
     extension : str, optional
         The file extension to reproject. Default is '.tif'
+    n_jobs : int, optional
+        The number of images to reproject at once. Defaults to -1 (one per core). The cores and the 2GB warp memory
+        are shared out between the workers.
+    skip_existing : bool, optional
+        If True, skips any image whose output is already in out_dir and was written after the image was last changed.
+        The output's projection is not checked. Defaults to False.
 
     """
     log = logging.getLogger(__name__)
-    image_paths = [os.path.join(in_dir, image_path) for image_path in os.listdir(in_dir) if image_path.endswith(extension)]
-    for image_path in image_paths:
-        reproj_path = os.path.join(out_dir, os.path.basename(image_path))
+    with os.scandir(in_dir) as entries:
+        image_entries = [entry for entry in entries if entry.name.endswith(extension) and entry.is_file()]
+    if skip_existing:
+        stale_entries = []
+        for entry in image_entries:
+            if _is_newer(os.path.join(out_dir, entry.name), entry.stat()):
+                log.info("{} is already reprojected, skipping".format(entry.path))
+            else:
+                stale_entries.append(entry)
+        image_entries = stale_entries
+    image_paths = [entry.path for entry in image_entries]
+    reproj_paths = [os.path.join(out_dir, entry.name) for entry in image_entries]
+    for image_path, reproj_path in zip(image_paths, reproj_paths):
         log.info("Reprojecting {} to {}, storing in {}".format(image_path, reproj_path, new_projection))
-        reproject_image(image_path, reproj_path, new_projection)
+    # Each warp reads and writes its own files, so the images can be reprojected in separate processes. The workers
+    # split the cores and reproject_image's default warp memory between them, so that n_jobs=-1 uses the same
+    # threads and memory in total as reprojecting one image at a time.
+    n_workers = max(1, min(effective_n_jobs(n_jobs), len(image_paths)))
+    gdal_threads = max(1, cpu_count() // n_workers)
+    memory = 2e3 / n_workers
+    Parallel(n_jobs=n_jobs, backend="loky", batch_size=1)(
+        delayed(_reproject_image_worker)(image_path, reproj_path, new_projection, memory, gdal_threads)
+        for image_path, reproj_path in zip(image_paths, reproj_paths))
+
+
+def _reproject_image_worker(in_raster, out_raster_path, new_projection, memory, gdal_threads=None):
+    """Reprojects a single image for :py:func:`reproject_directory`"""
+    if gdal_threads and "GDAL_NUM_THREADS" not in os.environ:
+        gdal.SetConfigOption("GDAL_NUM_THREADS", str(gdal_threads))
+    return reproject_image(in_raster, out_raster_path, new_projection, memory=memory)
+
+
+def _is_newer(path, source_stat):
+    """
+    :meta private:
+    True if path exists and was last modified after the file that source_stat came from.
+    """
+    try:
+        return os.stat(path).st_mtime_ns > source_stat.st_mtime_ns
+    except OSError:
+        return False
 
 
 def reproject_image(in_raster, out_raster_path, new_projection,  driver = "GTiff",  memory = 2e3, do_post_resample=True):
@@ -776,9 +1020,7 @@ def reproject_image(in_raster, out_raster_path, new_projection,  driver = "GTiff
 
     """
     if type(new_projection) is int:
-        proj = osr.SpatialReference()
-        proj.ImportFromEPSG(new_projection)
-        new_projection = proj.ExportToWkt()
+        new_projection = epsg_to_wkt(new_projection)
     log = logging.getLogger(__name__)
     log.info("Reprojecting {} to {}".format(in_raster, new_projection))
     if type(in_raster) is str:
@@ -817,9 +1059,7 @@ def composite_directory(image_dir, composite_out_dir, format="GTiff", generate_d
     """
     log = logging.getLogger(__name__)
     log.info("Compositing {}".format(image_dir))
-    sorted_image_paths = [os.path.join(image_dir, image_name) for image_name
-                          in sort_by_timestamp(os.listdir(image_dir), recent_first=False)  # Let's think about this
-                          if image_name.endswith(".tif")]
+    sorted_image_paths = get_sorted_image_paths(image_dir, suffix=".tif", recent_first=False)
     last_timestamp = get_sen_2_image_timestamp(os.path.basename(sorted_image_paths[-1]))
     composite_out_path = os.path.join(composite_out_dir, "composite_{}.tif".format(last_timestamp))
     composite_images_with_mask(sorted_image_paths, composite_out_path, format, generate_date_image=generate_date_images)
@@ -841,11 +1081,17 @@ def flatten_probability_image(prob_image, out_path):
     """
     prob_raster = gdal.Open(prob_image)
     out_raster = create_matching_dataset(prob_raster, out_path, bands=1)
-    prob_array = prob_raster.GetVirtualMemArray()
-    out_array = out_raster.GetVirtualMemArray(eAccess=gdal.GA_Update)
-    out_array[:, :] = prob_array.max(axis=0)
-    out_array = None
-    prob_array = None
+    # Accumulates the maximum a band at a time over strips of rows, so neither the full probability stack nor a
+    # temporary the size of it is ever held in memory
+    width = prob_raster.RasterXSize
+    out_band = out_raster.GetRasterBand(1)
+    for y_offset, rows in _row_windows(prob_raster):
+        max_strip = prob_raster.GetRasterBand(1).ReadAsArray(0, y_offset, width, rows)
+        for band_index in range(2, prob_raster.RasterCount + 1):
+            np.maximum(max_strip, prob_raster.GetRasterBand(band_index).ReadAsArray(0, y_offset, width, rows),
+                       out=max_strip)
+        out_band.WriteArray(max_strip, 0, y_offset)
+    out_band = None
     out_raster = None
     prob_raster = None
 
@@ -873,10 +1119,12 @@ def get_masked_array(raster, mask_path):
     mask = gdal.Open(mask_path)
     mask_array = mask.GetVirtualMemArray().squeeze()
     raster_array = raster.GetVirtualMemArray()
-    # If the shapes do not match, assume single-band mask for multi-band raster
+    # If the shapes do not match, assume single-band mask for multi-band raster. The mask is inverted before it is
+    # projected, and projected as a view, so only one band's worth of mask is ever allocated.
+    mask_array = np.logical_not(mask_array)
     if len(mask_array.shape) == 2 and len(raster_array.shape) == 3:
-        mask_array = project_array(np.asarray(mask_array), raster_array.shape[0], 0)
-    return np.ma.array(raster_array, mask=np.logical_not(mask_array))
+        mask_array = project_array_view(mask_array, raster_array.shape[0], 0)
+    return np.ma.array(raster_array, mask=mask_array)
 
 
 def stack_and_trim_images(old_image_path, new_image_path, aoi_path, out_image):
@@ -937,9 +1185,10 @@ def clip_raster(raster_path, aoi_path, out_path, srs_id=4326, flip_x_y = False,
         in_gt = raster.GetGeoTransform()
         srs = osr.SpatialReference()
         srs.ImportFromWkt(raster.GetProjection())
+        srs_wkt = srs.ExportToWkt()
         intersection_path = os.path.join(td, 'intersection')
         aoi = ogr.Open(aoi_path)
-        if aoi.GetLayer(0).GetSpatialRef().ExportToWkt() != srs.ExportToWkt():
+        if aoi.GetLayer(0).GetSpatialRef().ExportToWkt() != srs_wkt:
             log.info("Non-matching projections, reprojecting.")
             aoi = None
             tmp_aoi_path = os.path.join(td, "tmp_aoi.shp")
@@ -953,7 +1202,7 @@ def clip_raster(raster_path, aoi_path, out_path, srs_id=4326, flip_x_y = False,
         width_pix = int(np.floor(max_x_geo - min_x_geo)/in_gt[1])
         height_pix = int(np.floor(max_y_geo - min_y_geo)/np.absolute(in_gt[5]))
         new_geotransform = (min_x_geo, in_gt[1], 0, max_y_geo, 0, in_gt[5])
-        write_geometry(intersection, intersection_path, srs_id=srs.ExportToWkt())
+        write_geometry(intersection, intersection_path, srs_id=srs_wkt)
         aoi = None
         clip_spec = gdal.WarpOptions(
             format="GTiff",
@@ -994,7 +1243,8 @@ def clip_raster_to_intersection(raster_to_clip_path, extent_raster_path, out_ras
 
 
 def create_new_image_from_polygon(polygon, out_path, x_res, y_res, bands,
-                           projection, format="GTiff", datatype = gdal.GDT_Int32, nodata = -9999):
+                           projection, format="GTiff", datatype = gdal.GDT_Int32, nodata = -9999,
+                           creation_options=None):
     """
     Returns an empty image that covers the extent of the imput polygon.
 
@@ -1016,6 +1266,10 @@ def create_new_image_from_polygon(polygon, out_path, x_res, y_res, bands,
         The gdal raster format of the output image. Defaults to "Gtiff"
     datatype : gdal datatype, optional
         The gdal datatype of the output image. Defaults to gdal.GDT_Int32
+    creation_options : list of str, optional
+        Driver creation options for the new image. Defaults to `TILED_UPDATE_GTIFF_OPTIONS` for GTiff output, so
+        that later windowed reads and writes touch whole tiles rather than scanlines, and the driver defaults
+        otherwise.
 
     Returns
     -------
@@ -1023,6 +1277,8 @@ def create_new_image_from_polygon(polygon, out_path, x_res, y_res, bands,
 
     """
     # TODO: Implement nodata
+    if creation_options is None:
+        creation_options = TILED_UPDATE_GTIFF_OPTIONS if format == "GTiff" else []
     bounds_x_min, bounds_x_max, bounds_y_min, bounds_y_max = polygon.GetEnvelope()
     if bounds_x_min >= bounds_x_max:
         bounds_x_min, bounds_x_max = bounds_x_max, bounds_x_min
@@ -1033,7 +1289,7 @@ def create_new_image_from_polygon(polygon, out_path, x_res, y_res, bands,
     driver = gdal.GetDriverByName(format)
     out_raster = driver.Create(
         out_path, xsize=final_width_pixels, ysize=final_height_pixels,
-        bands=bands, eType=datatype
+        bands=bands, eType=datatype, options=creation_options
     )
     out_raster.SetGeoTransform([
         bounds_x_min, x_res, 0,
@@ -1198,18 +1454,34 @@ def calc_ndvi(raster_path, output_path):
     """
     raster = gdal.Open(raster_path)
     out_raster = create_matching_dataset(raster, output_path, datatype=gdal.GDT_Float32)
-    array = raster.GetVirtualMemArray()
-    out_array = out_raster.GetVirtualMemArray(eAccess=gdal.GA_Update)
-    R = array[2, ...]
-    I = array[3, ...]
-    out_array[...] = (R-I)/(R+I)
-
-    out_array[...] = np.where(out_array == -2147483648, 0, out_array)
+    # Worked through in strips a whole number of blocks high, so the temporaries of the band maths are strip-sized
+    # rather than image-sized and every block of the red and infrared bands is read once
+    width = raster.RasterXSize
+    red_band = raster.GetRasterBand(3)
+    ir_band = raster.GetRasterBand(4)
+    out_band = out_raster.GetRasterBand(1)
+    windows = list(_row_windows(raster))
+    strip_shape = (windows[0][1], width)
+    # One set of strip buffers is reused for every strip; gdal reads into them through buf_obj and the band maths
+    # writes into them through out=, so nothing is allocated per strip
+    red_buffer = np.empty(strip_shape, dtype=GDALTypeCodeToNumericTypeCode(red_band.DataType))
+    ir_buffer = np.empty(strip_shape, dtype=GDALTypeCodeToNumericTypeCode(ir_band.DataType))
+    maths_dtype = np.result_type(red_buffer, ir_buffer)
+    diff_buffer = np.empty(strip_shape, dtype=maths_dtype)
+    sum_buffer = np.empty(strip_shape, dtype=maths_dtype)
+    out_buffer = np.empty(strip_shape, dtype=np.float32)
+    for y_offset, rows in windows:
+        R = red_band.ReadAsArray(0, y_offset, width, rows, buf_obj=red_buffer[:rows])
+        I = ir_band.ReadAsArray(0, y_offset, width, rows, buf_obj=ir_buffer[:rows])
+        diff = np.subtract(R, I, out=diff_buffer[:rows])
+        total = np.add(R, I, out=sum_buffer[:rows])
+        out_strip = np.true_divide(diff, total, out=out_buffer[:rows])
+        out_strip[out_strip == -2147483648] = 0  # in place, rather than building a replacement array with np.where
+        out_band.WriteArray(out_strip, 0, y_offset)
 
     R = None
     I = None
-    array = None
-    out_array = None
+    out_band = None
     raster = None
     out_raster = None
 
@@ -1343,15 +1615,19 @@ def raster_sum(inRstList, outFn, outFmt='GTiff'):
     # Get raster shape
     rst_dim = (in_band.YSize, in_band.XSize)
 
-    # initiate empty array
-    empty_arr = np.empty(rst_dim, dtype=np.uint8)
+    # The sum and a single read buffer are allocated once from the first band's size; each raster is read straight
+    # into the buffer and added to the sum in place, rather than a new sum array being made for every raster.
+    in_dtype = GDALTypeCodeToNumericTypeCode(in_band.DataType)
+    empty_arr = np.zeros(rst_dim, dtype=np.result_type(np.uint8, in_dtype))
+    read_buffer = np.empty(rst_dim, dtype=in_dtype)
 
     for i, rst in enumerate(inRstList):
         # Todo: Check that dimensions and shape of both arrays are the same in the first loop.
         ds = gdal.Open(rst)
         bnd = ds.GetRasterBand(1)
-        arr = bnd.ReadAsArray()
-        empty_arr = empty_arr + arr
+        arr = bnd.ReadAsArray(buf_obj=read_buffer)
+        np.add(empty_arr, arr, out=empty_arr, casting="unsafe")
+        ds = None
 
     # Create a 1 band GeoTiff with the same properties as the input raster
     driver = gdal.GetDriverByName(outFmt)
@@ -1459,12 +1735,12 @@ def open_dataset_from_safe(safe_file_path, band, resolution = "10m"):
     #image_glob = r"GRANULE/*/IMG_DATA/*_{}.jp2".format(band)
     fp_glob = os.path.join(safe_file_path, image_glob)
     image_file_path = glob.glob(fp_glob)
-    out = gdal.Open(image_file_path[0])
+    out = _open_read_only(image_file_path[0])
     return out
 
 
 def preprocess_sen2_images(l2_dir, out_dir, l1_dir, cloud_threshold=60, buffer_size=0, epsg=None,
-                           bands=("B02", "B03", "B04", "B08"), out_resolution=10):
+                           bands=("B02", "B03", "B04", "B08"), out_resolution=10, n_jobs=-1, skip_existing=False):
     """
     For every .SAFE folder in l2_dir and L1_dir, stacks band 2,3,4 and 8  bands into a single geotif, creates a cloudmask from
     the combined fmask and sen2cor cloudmasks and reprojects to a given EPSG if provided.
@@ -1487,6 +1763,11 @@ def preprocess_sen2_images(l2_dir, out_dir, l1_dir, cloud_threshold=60, buffer_s
         List of names of bands to include in the final rasters. Defaults to ("B02", "B03", "B04", "B08")
     out_resolution : number, optional
         Resolution to resample every image to - units are defined by the image projection. Default is 10.
+    n_jobs : int, optional
+        The number of .SAFE folders to process at once. Defaults to -1 (one per core)
+    skip_existing : bool, optional
+        If True, skips any .SAFE folder whose image and mask are already in out_dir and were written after the .SAFE
+        folder was last changed. Defaults to False.
 
     Warnings
     --------
@@ -1495,37 +1776,58 @@ def preprocess_sen2_images(l2_dir, out_dir, l1_dir, cloud_threshold=60, buffer_s
 
 
     """
-    safe_file_path_list = [os.path.join(l2_dir, safe_file_path) for safe_file_path in os.listdir(l2_dir)]
-    for l2_safe_file in safe_file_path_list:
-        with TemporaryDirectory() as temp_dir:
-            log.info("----------------------------------------------------")
-            log.info("Merging 10m bands in SAFE dir: {}".format(l2_safe_file))
-            temp_path = os.path.join(temp_dir, get_sen_2_granule_id(l2_safe_file)) + ".tif"
-            log.info("Output file: {}".format(temp_path))
-            stack_sentinel_2_bands(l2_safe_file, temp_path, bands=bands, out_resolution=out_resolution)
-
-            log.info("Creating cloudmask for {}".format(temp_path))
-            l1_safe_file = get_l1_safe_file(l2_safe_file, l1_dir)
-            mask_path = get_mask_path(temp_path)
-            create_mask_from_sen2cor_and_fmask(l1_safe_file, l2_safe_file, mask_path, buffer_size=buffer_size)
-            log.info("Cloudmask created")
-
-            out_path = os.path.join(out_dir, os.path.basename(temp_path))
-            out_mask_path = os.path.join(out_dir, os.path.basename(mask_path))
-
-            if epsg:
-                log.info("Reprojecting images to {}".format(epsg))
-                proj = osr.SpatialReference()
-                proj.ImportFromEPSG(epsg)
-                wkt = proj.ExportToWkt()
-                reproject_image(temp_path, out_path, wkt)
-                reproject_image(mask_path, out_mask_path, wkt)
-                resample_image_in_place(out_mask_path, out_resolution)
-            else:
-                log.info("Moving images to {}".format(out_dir))
-                shutil.move(temp_path, out_path)
-                shutil.move(mask_path, out_mask_path)
-                resample_image_in_place(out_mask_path, out_resolution)
+    safe_file_path_list = get_safe_dirs(l2_dir)
+    # Each .SAFE is independent, so they can be stacked and masked in separate processes. The cores are shared out
+    # between the workers for JPEG2000 decoding, rather than every worker starting a decode thread per core.
+    n_workers = max(1, min(effective_n_jobs(n_jobs), len(safe_file_path_list)))
+    gdal_threads = max(1, cpu_count() // n_workers)
+    Parallel(n_jobs=n_jobs, backend="loky", batch_size=1)(
+        delayed(_preprocess_sen2_image)(l2_safe_file, out_dir, l1_dir, buffer_size, epsg, bands, out_resolution,
+                                        skip_existing, gdal_threads)
+        for l2_safe_file in safe_file_path_list)
+
+
+def _preprocess_sen2_image(l2_safe_file, out_dir, l1_dir, buffer_size, epsg, bands, out_resolution,
+                           skip_existing=False, gdal_threads=None):
+    """Stacks and masks a single L2 .SAFE folder for :py:func:`preprocess_sen2_images`"""
+    if gdal_threads and "GDAL_NUM_THREADS" not in os.environ:
+        gdal.SetConfigOption("GDAL_NUM_THREADS", str(gdal_threads))
+    if skip_existing:
+        # Stacking, fmask and reprojection are the slow part of every run, so outputs that are newer than the .SAFE
+        # they came from are left alone
+        out_path = os.path.join(out_dir, get_sen_2_granule_id(l2_safe_file)) + ".tif"
+        out_paths = (out_path, get_mask_path(out_path))
+        safe_mtime = os.path.getmtime(l2_safe_file)
+        if all(os.path.exists(path) and os.path.getmtime(path) > safe_mtime for path in out_paths):
+            log.info("{} and its mask are up to date, skipping".format(out_path))
+            return
+    with TemporaryDirectory() as temp_dir:
+        log.info("----------------------------------------------------")
+        log.info("Merging 10m bands in SAFE dir: {}".format(l2_safe_file))
+        temp_path = os.path.join(temp_dir, get_sen_2_granule_id(l2_safe_file)) + ".tif"
+        log.info("Output file: {}".format(temp_path))
+        stack_sentinel_2_bands(l2_safe_file, temp_path, bands=bands, out_resolution=out_resolution)
+
+        log.info("Creating cloudmask for {}".format(temp_path))
+        l1_safe_file = get_l1_safe_file(l2_safe_file, l1_dir)
+        mask_path = get_mask_path(temp_path)
+        create_mask_from_sen2cor_and_fmask(l1_safe_file, l2_safe_file, mask_path, buffer_size=buffer_size)
+        log.info("Cloudmask created")
+
+        out_path = os.path.join(out_dir, os.path.basename(temp_path))
+        out_mask_path = os.path.join(out_dir, os.path.basename(mask_path))
+
+        if epsg:
+            log.info("Reprojecting images to {}".format(epsg))
+            wkt = epsg_to_wkt(epsg)
+            reproject_image(temp_path, out_path, wkt)
+            reproject_image(mask_path, out_mask_path, wkt)
+            resample_image_in_place(out_mask_path, out_resolution)
+        else:
+            log.info("Moving images to {}".format(out_dir))
+            shutil.move(temp_path, out_path)
+            shutil.move(mask_path, out_mask_path)
+            resample_image_in_place(out_mask_path, out_resolution)
 
 
 def preprocess_landsat_images(image_dir, out_image_path, new_projection = None, bands_to_stack=("B2","B3","B4")):
@@ -1557,17 +1859,15 @@ def preprocess_landsat_images(image_dir, out_image_path, new_projection = None,
     n_bands = len(band_path_list)
     driver = gdal.GetDriverByName("GTiff")
     first_ls_raster = gdal.Open(band_path_list[0])
-    first_ls_array = first_ls_raster.GetVirtualMemArray()
     out_image = driver.Create(out_image_path,
-            xsize = first_ls_array.shape[1],
-            ysize = first_ls_array.shape[0],
+            xsize = first_ls_raster.RasterXSize,
+            ysize = first_ls_raster.RasterYSize,
             bands = n_bands,
             eType = first_ls_raster.GetRasterBand(1).DataType
             )
     out_image.SetGeoTransform(first_ls_raster.GetGeoTransform())
     out_image.SetProjection(first_ls_raster.GetProjection())
     out_array = out_image.GetVirtualMemArray(eAccess = gdal.GA_Update)
-    first_ls_array = None
     first_ls_raster = None
     for ii, ls_raster_path in enumerate(band_path_list):
         log.info("Stacking {} to raster layer {}".format(ls_raster_path, ii))
@@ -1612,20 +1912,24 @@ def stack_sentinel_2_bands(safe_dir, out_image_path, bands=("B02", "B03", "B04",
 
     """
 
-    band_paths = [get_sen_2_band_path(safe_dir, band, out_resolution) for band in bands]
+    # One listing of the .SAFE serves every band, and the band order is exactly the order of bands
+    safe_images = _list_safe_images(safe_dir)
+    band_paths = [_select_sen_2_band_path(safe_images, safe_dir, band, out_resolution) for band in bands]
 
-    # Move every image NOT in the requested resolution to resample_dir and resample
+    # Move every image NOT in the requested resolution to resample_dir and resample.
+    # Each band is copied and warped on its own thread; gdal lets go of the GIL while it decodes and warps, and every
+    # band works on its own files.
     with TemporaryDirectory() as resample_dir:
-        new_band_paths = []
-        for band_path in band_paths:
-            if get_image_resolution(band_path) != out_resolution:
-                log.info("Resampling {} to {}m".format(band_path, out_resolution))
-                resample_path = os.path.join(resample_dir, os.path.basename(band_path))
-                shutil.copy(band_path, resample_path)
-                resample_image_in_place(resample_path, out_resolution)  # why did I make this the only in-place function?
-                new_band_paths.append(resample_path)
-            else:
-                new_band_paths.append(band_path)
+        new_band_paths = list(band_paths)
+        to_resample = [index for index, band_path in enumerate(band_paths)
+                       if _open_read_only(band_path).GetGeoTransform()[1] != out_resolution]
+        if to_resample:
+            with ThreadPoolExecutor(max_workers=len(to_resample)) as executor:
+                resampled_paths = executor.map(_resample_band_copy, [band_paths[index] for index in to_resample],
+                                               [resample_dir] * len(to_resample),
+                                               [out_resolution] * len(to_resample))
+                for index, resample_path in zip(to_resample, resampled_paths):
+                    new_band_paths[index] = resample_path
 
         stack_images(new_band_paths, out_image_path, geometry_mode="intersect")
 
@@ -1638,6 +1942,18 @@ def stack_sentinel_2_bands(safe_dir, out_image_path, bands=("B02", "B03", "B04",
     return out_image_path
 
 
+def _resample_band_copy(band_path, resample_dir, out_resolution):
+    """
+    :meta private:
+    Copies band_path into resample_dir, resamples the copy to out_resolution and returns the copy's path.
+    """
+    log.info("Resampling {} to {}m".format(band_path, out_resolution))
+    resample_path = os.path.join(resample_dir, os.path.basename(band_path))
+    shutil.copy(band_path, resample_path)
+    resample_image_in_place(resample_path, out_resolution)  # why did I make this the only in-place function?
+    return resample_path
+
+
 def get_sen_2_band_path(safe_dir, band, resolution=None):
     """
     Returns the path to the raster of the specified band in the specified safe_dir.
@@ -1656,6 +1972,37 @@ def get_sen_2_band_path(safe_dir, band, resolution=None):
     band_path : str
         The path to the raster containing the band.
 
+    """
+    return _select_sen_2_band_path(_list_safe_images(safe_dir), safe_dir, band, resolution)
+
+
+def _list_safe_images(safe_dir):
+    """
+    :meta private:
+    Lists every file in GRANULE/*/IMG_DATA of a .SAFE file and its resolution subfolders, using one scandir per
+    directory. Returns a sorted list of (subfolder, filename, path) tuples; subfolder is "" for files directly in
+    IMG_DATA (L1C) and eg "R10m" for L2A.
+    """
+    images = []
+    with os.scandir(os.path.join(safe_dir, "GRANULE")) as granules:
+        img_data_dirs = [os.path.join(granule.path, "IMG_DATA") for granule in granules if granule.is_dir()]
+    for img_data_dir in img_data_dirs:
+        if not os.path.isdir(img_data_dir):
+            continue
+        with os.scandir(img_data_dir) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    with os.scandir(entry.path) as sub_entries:
+                        images.extend((entry.name, sub.name, sub.path) for sub in sub_entries if sub.is_file())
+                else:
+                    images.append(("", entry.name, entry.path))
+    return sorted(images, key=lambda image: image[2])
+
+
+def _select_sen_2_band_path(safe_images, safe_dir, band, resolution=None):
+    """
+    :meta private:
+    Picks the path of band out of a listing from :py:func:`_list_safe_images`. See :py:func:`get_sen_2_band_path`.
     """
     if resolution == 10:
         res_string = "10m"
@@ -1667,31 +2014,26 @@ def get_sen_2_band_path(safe_dir, band, resolution=None):
         res_string = None
 
     if get_safe_product_type(safe_dir) == "MSIL1C":
-        band_glob = "GRANULE/*/IMG_DATA/*_{}*.*".format(band)
-        band_glob = os.path.join(safe_dir, band_glob)
-        band_paths = glob.glob(band_glob)
+        band_paths = [path for subdir, name, path in safe_images
+                      if subdir == "" and fnmatch.fnmatchcase(name, "*_{}*.*".format(band))]
         if not band_paths:
             raise FileNotFoundError("Band {} not found for safe file {}".format(band, safe_dir))
-        band_path = band_paths[0]
+        return band_paths[0]
 
-    else:
-        if res_string in ["10m", "20m", "60m"]:  # If resolution is given, then find the band of that resolution
-            band_glob = "GRANULE/*/IMG_DATA/R{}/*_{}_*.*".format(res_string, band)
-            band_glob = os.path.join(safe_dir, band_glob)
-            try:
-                band_path = glob.glob(band_glob)[0]
-            except IndexError:
-                log.warning("Band {} not found of specified resolution, searching in other available resolutions".format(band))
-
-        if res_string is None or 'band_path' not in locals():  # Else use the highest resolution available for that band
-            band_glob = "GRANULE/*/IMG_DATA/R*/*_{}_*.*".format(band)
-            band_glob = os.path.join(safe_dir, band_glob)
-            band_paths = glob.glob(band_glob)
-            try:
-                band_path = sorted(band_paths)[0] # Sorting alphabetically gives the highest resolution first
-            except TypeError:
-                raise FileNotFoundError("Band {} not found for safe file {}". format(band, safe_dir))
-    return band_path
+    band_pattern = "*_{}_*.*".format(band)
+    if res_string in ["10m", "20m", "60m"]:  # If resolution is given, then find the band of that resolution
+        band_paths = [path for subdir, name, path in safe_images
+                      if subdir == "R" + res_string and fnmatch.fnmatchcase(name, band_pattern)]
+        if band_paths:
+            return band_paths[0]
+        log.warning("Band {} not found of specified resolution, searching in other available resolutions".format(band))
+
+    # Else use the highest resolution available for that band
+    band_paths = [path for subdir, name, path in safe_images
+                  if subdir.startswith("R") and fnmatch.fnmatchcase(name, band_pattern)]
+    if not band_paths:
+        raise FileNotFoundError("Band {} not found for safe file {}".format(band, safe_dir))
+    return band_paths[0]  # The listing is sorted by path, so the highest resolution comes first
 
 
 def get_image_resolution(image_path):
@@ -1756,11 +2098,15 @@ def stack_old_and_new_images(old_image_path, new_image_path, out_dir, create_com
         new_timestamp = get_sen_2_image_timestamp(os.path.basename(new_image_path))
         out_path = os.path.join(out_dir, tile_new + '_' + old_timestamp + '_' + new_timestamp)
         log.info("Output stacked file: {}".format(out_path + ".tif"))
-        stack_images([old_image_path, new_image_path], out_path + ".tif")
         if create_combined_mask:
-            out_mask_path = out_path + ".msk"
             old_mask_path = get_mask_path(old_image_path)
             new_mask_path = get_mask_path(new_image_path)
+            _check_masks_exist([old_mask_path, new_mask_path])
+        # Keep the source datatype (UInt16 for S2 L2A) rather than widening every band to Int32
+        stack_images([old_image_path, new_image_path], out_path + ".tif", datatype=None,
+                     creation_options=_tiled_gtiff_options())
+        if create_combined_mask:
+            out_mask_path = out_path + ".msk"
             combine_masks([old_mask_path, new_mask_path], out_mask_path, combination_func="and", geometry_func="intersect")
         return out_path + ".tif"
     else:
@@ -1787,26 +2133,26 @@ def apply_sen2cor(image_path, sen2cor_path, delete_unprocessed_image=False):
 
     """
     # Here be OS magic. Since sen2cor runs in its own process, Python has to spin around and wait
-    # for it; since it's doing that, it may as well be logging the output from sen2cor. This
-    # approach can be multithreaded in future to process multiple image (1 per core) but that
-    # will take some work to make sure they all finish before the program moves on.
+    # for it; since it's doing that, it may as well be logging the output from sen2cor. Several
+    # images can be processed at once with atmospheric_correction, which runs this in a process pool.
+    # stderr is merged into stdout so that a chatty stderr can never fill its pipe and stall sen2cor, and
+    # lines are handled as raw bytes to skip decoding the ones that are only scanned.
     # added sen2cor_path by hb91
     out_dir = os.path.dirname(image_path)
     log.info("calling subprocess: {}".format([sen2cor_path, image_path, '--output_dir', os.path.dirname(image_path)]))
     now_time = datetime.datetime.now()   # I can't think of a better way of geting the new outpath from sen2cor
     timestamp = now_time.strftime(r"%Y%m%dT%H%M%S")
     sen2cor_proc = subprocess.Popen([sen2cor_path, image_path, '--output_dir', os.path.dirname(image_path)],
-                                    stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                                    universal_newlines=True)
-    while True:
-        nextline = sen2cor_proc.stdout.readline()
-        if len(nextline) > 0:
-            log.info(nextline)
-        if nextline == '' and sen2cor_proc.poll() is not None:
-            break
-        if "CRITICAL" in nextline:
-            #log.error(nextline)
-            raise subprocess.CalledProcessError(-1, "L2A_Process")
+                                    stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                    bufsize=1 << 16)
+    with sen2cor_proc.stdout:
+        for nextline in iter(sen2cor_proc.stdout.readline, b''):
+            log.info(nextline.decode("latin-1").rstrip())
+            if b"CRITICAL" in nextline:
+                sen2cor_proc.kill()
+                sen2cor_proc.wait()
+                raise subprocess.CalledProcessError(-1, "L2A_Process")
+    sen2cor_proc.wait()
 
     log.info("sen2cor processing finished for {}".format(image_path))
     log.info("Validating:")
@@ -1817,6 +2163,7 @@ def apply_sen2cor(image_path, sen2cor_path, delete_unprocessed_image=False):
         raise BadS2Exception
     if delete_unprocessed_image:
         log.info("removing {}".format(image_path))
+        close_cached_datasets()
         shutil.rmtree(image_path)
     return out_path
 
@@ -1865,7 +2212,22 @@ def get_sen2cor_version(sen2cor_path):
     version : str
         A string of the version of sen2cor at sen2cor_path
 
+    Notes
+    -----
+    Each lookup runs sen2cor, so the version is cached against the executable's modification time; an upgraded
+    sen2cor at the same path is asked again.
+
     """
+    try:
+        mtime = os.stat(shutil.which(sen2cor_path) or sen2cor_path).st_mtime_ns
+    except OSError:
+        mtime = None
+    return _sen2cor_version(sen2cor_path, mtime)
+
+
+@functools.lru_cache(maxsize=16)
+def _sen2cor_version(sen2cor_path, mtime):
+    """:meta private:"""
     proc = subprocess.run([sen2cor_path, "--help"], stdout=subprocess.PIPE)
     help_string = proc.stdout.decode("utf-8")
 
@@ -1879,7 +2241,7 @@ def get_sen2cor_version(sen2cor_path):
         raise FileNotFoundError("Version information not found; please check your sen2cor path.")
 
 
-def atmospheric_correction(in_directory, out_directory, sen2cor_path, delete_unprocessed_image=False):
+def atmospheric_correction(in_directory, out_directory, sen2cor_path, delete_unprocessed_image=False, n_workers=1):
     """
     Applies Sen2cor atmospheric correction to each L1 image in in_directory
 
@@ -1893,32 +2255,41 @@ def atmospheric_correction(in_directory, out_directory, sen2cor_path, delete_unp
         Path to the l2a_process script (Linux) or l2a_process.exe (Windows)
     delete_unprocessed_image : bool, optional
         If True, delete the unprocessed image after processing is done. Defaults to False.
+    n_workers : int, optional
+        The number of sen2cor processes to run at once. Each one is multithreaded and needs several GB of memory, so
+        only raise this on machines with the memory for it. Defaults to 1.
 
     """
     log = logging.getLogger(__name__)
     images = [image for image in os.listdir(in_directory)
               if image.startswith('MSIL1C', 4)]
-    # Opportunity for multithreading here
-    for image in images:
-        log.info("Atmospheric correction of {}".format(image))
-        image_path = os.path.join(in_directory, image)
-        image_timestamp = datetime.datetime.now().strftime(r"%Y%m%dT%H%M%S")
-        out_name = build_sen2cor_output_path(image, image_timestamp, get_sen2cor_version(sen2cor_path))
-        out_path = os.path.join(out_directory, out_name)
-        out_glob = out_path.rpartition("_")[0] + "*"
-        if glob.glob(out_glob):
-            log.warning("{} exists. Skipping.".format(out_path))
-            continue
-        try:
-            l2_path = apply_sen2cor(image_path, sen2cor_path, delete_unprocessed_image=delete_unprocessed_image)
-        except (subprocess.CalledProcessError, BadS2Exception):
-            log.error("Atmospheric correction failed for {}. Moving on to next image.".format(image))
-            pass
-        else:
-            l2_name = os.path.basename(l2_path)
-            log.info("L2  path: {}".format(l2_path))
-            log.info("New path: {}".format(os.path.join(out_directory, l2_name)))
-            os.rename(l2_path, os.path.join(out_directory, l2_name))
+    # Each sen2cor run is an independent external process, so they can be run side by side
+    log.info("Running up to {} sen2cor processes at once".format(n_workers))
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = {}
+        for image in images:
+            image_path = os.path.join(in_directory, image)
+            image_timestamp = datetime.datetime.now().strftime(r"%Y%m%dT%H%M%S")
+            out_name = build_sen2cor_output_path(image, image_timestamp, get_sen2cor_version(sen2cor_path))
+            out_path = os.path.join(out_directory, out_name)
+            out_glob = out_path.rpartition("_")[0] + "*"
+            if glob.glob(out_glob):
+                log.warning("{} exists. Skipping.".format(out_path))
+                continue
+            log.info("Atmospheric correction of {}".format(image))
+            future = executor.submit(apply_sen2cor, image_path, sen2cor_path, delete_unprocessed_image)
+            futures[future] = image
+        for future in as_completed(futures):
+            image = futures[future]
+            try:
+                l2_path = future.result()
+            except (subprocess.CalledProcessError, BadS2Exception):
+                log.error("Atmospheric correction failed for {}. Moving on to next image.".format(image))
+            else:
+                l2_name = os.path.basename(l2_path)
+                log.info("L2  path: {}".format(l2_path))
+                log.info("New path: {}".format(os.path.join(out_directory, l2_name)))
+                os.rename(l2_path, os.path.join(out_directory, l2_name))
 
 
 def create_mask_from_model(image_path, model_path, model_clear=0, num_chunks=10, buffer_size=0):
@@ -1950,13 +2321,14 @@ def create_mask_from_model(image_path, model_path, model_clear=0, num_chunks=10,
         log.info("Building cloud mask for {} with model {}".format(image_path, model_path))
         temp_mask_path = os.path.join(td, "cat_mask.tif")
         classify_image(image_path, model_path, temp_mask_path, num_chunks=num_chunks)
-        temp_mask = gdal.Open(temp_mask_path, gdal.GA_Update)
-        temp_mask_array = temp_mask.GetVirtualMemArray()
+        temp_mask = gdal.Open(temp_mask_path)
         mask_path = get_mask_path(image_path)
         mask = create_matching_dataset(temp_mask, mask_path, datatype=gdal.GDT_Byte)
-        mask_array = mask.GetVirtualMemArray(eAccess=gdal.GF_Write)
-        mask_array[:, :] = np.where(temp_mask_array != model_clear, 0, 1)
-        temp_mask_array = None
+        # The mask is only ever written, so it is built in memory and written in one go rather than through a
+        # mapped view; the class map is a byte layer, so the comparison can overwrite it in place.
+        mask_array = temp_mask.GetRasterBand(1).ReadAsArray()
+        np.equal(mask_array, model_clear, out=mask_array)
+        mask.GetRasterBand(1).WriteArray(mask_array)
         mask_array = None
         temp_mask = None
         mask = None
@@ -1993,21 +2365,24 @@ def create_mask_from_confidence_layer(l2_safe_path, out_path, cloud_conf_thresho
     log.info("Creating mask for {} with {} confidence threshold".format(l2_safe_path, cloud_conf_threshold))
     if cloud_conf_threshold:
         cloud_glob = "GRANULE/*/QI_DATA/*CLD*_20m.jp2"  # This should match both old and new mask formats
-        cloud_path = glob.glob(os.path.join(l2_safe_path, cloud_glob))[0]
-        cloud_image = gdal.Open(cloud_path)
-        cloud_confidence_array = cloud_image.GetVirtualMemArray()
-        mask_array = (cloud_confidence_array < cloud_conf_threshold)
-        cloud_confidence_array = None
     else:
         cloud_glob = "GRANULE/*/IMG_DATA/R20m/*SCL*_20m.jp2"  # This should match both old and new mask formats
-        cloud_path = glob.glob(os.path.join(l2_safe_path, cloud_glob))[0]
-        cloud_image = gdal.Open(cloud_path)
-        scl_array = cloud_image.GetVirtualMemArray()
-        mask_array = np.isin(scl_array, (4, 5, 6))
-
-    mask_image = create_matching_dataset(cloud_image, out_path)
-    mask_image_array = mask_image.GetVirtualMemArray(eAccess=gdal.GF_Write)
-    np.copyto(mask_image_array, mask_array)
+    cloud_path = glob.glob(os.path.join(l2_safe_path, cloud_glob))[0]
+    cloud_image = _open_read_only(cloud_path)
+    cloud_array = cloud_image.GetRasterBand(1).ReadAsArray()
+    mask_image = create_matching_dataset(cloud_image, out_path, datatype=gdal.GDT_Byte)
+    # The mask is only ever written, so it is built in memory and written with one WriteArray rather than through a
+    # mapped view. Both branches write straight into it rather than through an intermediate boolean array.
+    mask_image_array = np.empty(cloud_array.shape, dtype=np.uint8)
+    if cloud_conf_threshold:
+        np.less(cloud_array, cloud_conf_threshold, out=mask_image_array)
+    else:
+        # SCL is a byte layer, so a 256-entry lookup table marks the clear classes in a single pass
+        clear_classes = np.zeros(256, dtype=np.uint8)
+        clear_classes[[4, 5, 6]] = 1  # vegetation, not vegetated, water
+        np.take(clear_classes, cloud_array, out=mask_image_array)
+    mask_image.GetRasterBand(1).WriteArray(mask_image_array)
+    cloud_array = None
     mask_image_array = None
     cloud_image = None
     mask_image = None
@@ -2045,10 +2420,16 @@ def create_mask_from_class_map(class_map_path, out_path, classes_of_interest, bu
     # TODO: pull this out of the above function
     class_image = gdal.Open(class_map_path)
     class_array = class_image.GetVirtualMemArray()
-    mask_array = np.isin(class_array, classes_of_interest)
     out_mask = create_matching_dataset(class_image, out_path, datatype=gdal.GDT_Byte)
     out_array = out_mask.GetVirtualMemArray(eAccess=gdal.GA_Update)
-    np.copyto(out_array, mask_array)
+    if class_array.dtype == np.uint8:
+        # Byte class maps (as classify_image writes) index straight into a 256 entry table of clear classes, in one
+        # pass and without isin's sort or a full size bool temporary
+        clear_classes = np.zeros(256, dtype=np.uint8)
+        clear_classes[[class_ for class_ in classes_of_interest if 0 <= class_ < 256]] = 1
+        np.take(clear_classes, class_array, out=out_array.reshape(class_array.shape))
+    else:
+        np.copyto(out_array, np.isin(class_array, classes_of_interest))
     class_array = None
     class_image = None
     out_array = None
@@ -2067,8 +2448,8 @@ def combine_masks(mask_paths, out_path, combination_func = 'and', geometry_func
 
     Parameters
     ----------
-    mask_paths : list of str
-        A list of paths to the masks to combine
+    mask_paths : list of str or gdal.Dataset
+        A list of paths to the masks to combine. Already-open datasets may be passed instead.
     out_path : str
         The path to the new mask
     combination_func : {'and' or 'or}, optional
@@ -2089,7 +2470,12 @@ def combine_masks(mask_paths, out_path, combination_func = 'and', geometry_func
     log = logging.getLogger(__name__)
     log.info("Combining masks {}:\n   combination function: '{}'\n   geometry function:'{}'".format(
         mask_paths, combination_func, geometry_func))
-    masks = [gdal.Open(mask_path) for mask_path in mask_paths]
+    if geometry_func not in ("intersect", "union"):
+        raise Exception("Invalid geometry_func; can be 'intersect' or 'union'")
+    if combination_func not in ("or", "and", "nor"):
+        raise Exception("Invalid combination_func; valid values are 'or', 'and', and 'nor'")
+
+    masks = [_open_raster(mask_path) for mask_path in mask_paths]
     combined_polygon = align_bounds_to_whole_number(get_combined_polygon(masks, geometry_func))
     gt = masks[0].GetGeoTransform()
     x_res = gt[1]
@@ -2104,30 +2490,30 @@ def combine_masks(mask_paths, out_path, combination_func = 'and', geometry_func
     out_mask_array = out_mask.GetVirtualMemArray(eAccess=gdal.GF_Write)
     out_mask_array = out_mask_array.squeeze() # This here to account for unaccountable extra dimension Windows patch adds
     out_mask_array[:, :] = 1
+    if geometry_func == "intersect":
+        out_x_min, out_x_max, out_y_min, out_y_max = pixel_bounds_from_polygon(out_mask, combined_polygon)
     for mask_index, in_mask in enumerate(masks):
         in_mask_array = in_mask.GetVirtualMemArray()
         in_mask_array = in_mask_array.squeeze()  # See previous comment
         if geometry_func == "intersect":
-            out_x_min, out_x_max, out_y_min, out_y_max = pixel_bounds_from_polygon(out_mask, combined_polygon)
             in_x_min, in_x_max, in_y_min, in_y_max = pixel_bounds_from_polygon(in_mask, combined_polygon)
-        elif geometry_func == "union":
-            out_x_min, out_x_max, out_y_min, out_y_max = pixel_bounds_from_polygon(out_mask, get_raster_bounds(in_mask))
-            in_x_min, in_x_max, in_y_min, in_y_max = pixel_bounds_from_polygon(in_mask, get_raster_bounds(in_mask))
         else:
-            raise Exception("Invalid geometry_func; can be 'intersect' or 'union'")
+            in_mask_bounds = get_raster_bounds(in_mask)
+            out_x_min, out_x_max, out_y_min, out_y_max = pixel_bounds_from_polygon(out_mask, in_mask_bounds)
+            in_x_min, in_x_max, in_y_min, in_y_max = pixel_bounds_from_polygon(in_mask, in_mask_bounds)
         out_mask_view = out_mask_array[out_y_min: out_y_max, out_x_min: out_x_max]
         in_mask_view = in_mask_array[in_y_min: in_y_max, in_x_min: in_x_max]
+        # The ufuncs write straight into the output view rather than building a full-size temporary each time
         if mask_index == 0:
             out_mask_view[:,:] = in_mask_view
-        else:
-            if combination_func == 'or':
-                out_mask_view[:, :] = np.bitwise_or(out_mask_view, in_mask_view, dtype=np.uint8)
-            elif combination_func == 'and':
-                out_mask_view[:, :] = np.bitwise_and(out_mask_view, in_mask_view, dtype=np.uint8)
-            elif combination_func == 'nor':
-                out_mask_view[:, :] = np.bitwise_not(np.bitwise_or(out_mask_view, in_mask_view, dtype=np.uint8), dtype=np.uint8)
-            else:
-                raise Exception("Invalid combination_func; valid values are 'or', 'and', and 'nor'")
+        elif combination_func == 'or':
+            np.bitwise_or(out_mask_view, in_mask_view, out=out_mask_view)
+        elif combination_func == 'and':
+            np.bitwise_and(out_mask_view, in_mask_view, out=out_mask_view)
+        elif combination_func == 'nor':
+            np.bitwise_or(out_mask_view, in_mask_view, out=out_mask_view)
+            # Masks are 0 or 1, and bitwise_not of a uint8 gives 255 or 254; flipping the low bit gives 1 or 0
+            np.bitwise_xor(out_mask_view, 1, out=out_mask_view)
         in_mask_view = None
         out_mask_view = None
         in_mask_array = None
@@ -2153,8 +2539,16 @@ def buffer_mask_in_place(mask_path, buffer_size):
     log.info("Buffering {} with buffer size {}".format(mask_path, buffer_size))
     mask = gdal.Open(mask_path, gdal.GA_Update)
     mask_array = mask.GetVirtualMemArray(eAccess=gdal.GA_Update)
-    cache = morph.binary_erosion(mask_array.squeeze(), selem=morph.disk(buffer_size))
-    np.copyto(mask_array, cache)
+    mask_view = mask_array.squeeze()
+    footprint = morph.disk(buffer_size)
+    if cv2 is not None and mask_view.dtype == np.uint8:
+        # OpenCV's erosion is SIMD-vectorised and can write straight back into the mapped mask; the default
+        # border leaves edge pixels unaffected, matching skimage's binary_erosion.
+        cv2.erode(mask_view, footprint.astype(np.uint8), dst=mask_view)
+    else:
+        cache = morph.binary_erosion(mask_view, footprint)
+        np.copyto(mask_view, cache)
+    mask_view = None
     mask_array = None
     mask = None
 
@@ -2179,8 +2573,11 @@ def apply_array_image_mask(array, mask, fill_value=0):
         The array with masked pixels replaced with fill_value
 
     """
-    stacked_mask = np.broadcast_to(mask, array.shape)
-    return np.where(stacked_mask == 1, array, fill_value)
+    # The mask is compared once at (y, x) and broadcast over the bands by np.where, rather than being broadcast first
+    # and compared at (bands, y, x), which built a bool temporary as large as the whole image
+    clear = np.asarray(mask) == 1
+    np.broadcast_to(clear, array.shape)  # Raises if the mask doesn't fit the image
+    return np.where(clear, array, fill_value)
 
 
 def create_mask_from_sen2cor_and_fmask(l1_safe_file, l2_safe_file, out_mask_path, buffer_size=0):
@@ -8,6 +8,7 @@ Original code at https://github.com/Forests2020-Indonesia/Topographic-Correction
 Method b: https://ieeexplore.ieee.org/document/8356797
 """
 
+import functools
 import gdal
 from tempfile import TemporaryDirectory
 import os.path as p
@@ -59,11 +60,7 @@ def get_dem_slope_and_angle(dem_path, slope_out_path, aspect_out_path):
 def get_pixel_latlon(raster, x, y):
     """For a given pixel in raster, gets the lat-lon value in EPSG 4326."""
     # TODO: Move to coordinate_manipulation
-    native_projection = osr.SpatialReference()
-    native_projection.ImportFromWkt(raster.GetProjection())
-    latlon_projection = osr.SpatialReference()
-    latlon_projection.ImportFromEPSG(4326)
-    transformer = osr.CoordinateTransformation(native_projection, latlon_projection)
+    transformer = _latlon_transformer(raster.GetProjection())
 
     geotransform = raster.GetGeoTransform()
     x_geo, y_geo = cm.pixel_to_point_coordinates([y,x], geotransform)  # Why did I do this reverse?
@@ -71,13 +68,23 @@ def get_pixel_latlon(raster, x, y):
     return lat, lon
 
 
-def _generate_latlon_transformer(raster):
+@functools.lru_cache(maxsize=16)
+def _latlon_transformer(projection_wkt):
+    """
+    :meta private:
+    A transformation from projection_wkt to EPSG 4326, cached on the projection so that per-pixel lookups on the
+    same image (or tile) don't parse both projections and set up PROJ each time.
+    """
     native_projection = osr.SpatialReference()
-    native_projection.ImportFromWkt(raster.GetProjection())
+    native_projection.ImportFromWkt(projection_wkt)
     latlon_projection = osr.SpatialReference()
     latlon_projection.ImportFromEPSG(4326)
+    return osr.CoordinateTransformation(native_projection, latlon_projection)
+
+
+def _generate_latlon_transformer(raster):
     geotransform = raster.GetGeoTransform()
-    return osr.CoordinateTransformation(native_projection, latlon_projection), geotransform
+    return _latlon_transformer(raster.GetProjection()), geotransform
 
 
 def generate_latlon(x, y,geotransform, transformer):
@@ -87,23 +94,13 @@ def generate_latlon(x, y,geotransform, transformer):
 
 
 def _generate_latlon_arrays(array, transformer, geotransform):
-    
-    def generate_latlon_for_here(x, y):
-        return generate_latlon(x, y, geotransform, transformer)
-
-    # The crude way. Ask someone if it is doable.
-    # Turns out it's not, at least not this way.
-    # Time for more linspace!
-
-
-    latlon_array = np.empty((array.size, 2))
-    x_list = np.arange(array.shape[0])
-    y_list = np.arange(array.shape[1])
-    x_mesh, y_mesh = np.meshgrid(x_list, y_list)
-    x_mesh = x_mesh.ravel()
-    y_mesh = y_mesh.ravel()
-    latlon_array[...,:] = list(map(generate_latlon_for_here, x_mesh, y_mesh))
-    return latlon_array[0], latlon_array[1]
+    # Every pixel is passed to the transformer in a single TransformPoints call; going through generate_latlon one
+    # pixel at a time meant a Python call and a PROJ call per pixel.
+    rows, cols = np.indices(array.shape)
+    x_geo, y_geo = cm.pixel_to_point_coordinates([rows.ravel(), cols.ravel()], geotransform)
+    points = transformer.TransformPoints(np.column_stack((x_geo, y_geo)).tolist())
+    latlon_array = np.array(points)[:, 1::-1]
+    return latlon_array[:, 0].reshape(array.shape), latlon_array[:, 1].reshape(array.shape)
 
 
 def generate_slope_and_aspect_rasters(dem_raster_path, out_directory):
@@ -144,11 +141,11 @@ def calculate_ic_array(slope_raster_path, aspect_raster_path, raster_datetime, i
         aspect_image = gdal.Open(aspect_raster_path)
         aspect_array = aspect_image.GetVirtualMemArray()
 
-        print("Calculating latlon arrays (this takes a while, for some reason.")
+        log.info("Calculating latlon arrays (this takes a while, for some reason.")
         transformer, geotransform = _generate_latlon_transformer(slope_image)
         lat_array, lon_array = _generate_latlon_arrays(aspect_array, transformer, geotransform)
 
-        print("pixels to process: {}".format(np.product(lat_array.shape)))
+        log.info("pixels to process: {}".format(np.product(lat_array.shape)))
         ic_array, zenith_array = ic_calculation(lat_array, lon_array, aspect_array, slope_array, raster_datetime)
         
         if ic_raster_out_path:
@@ -157,23 +154,23 @@ def calculate_ic_array(slope_raster_path, aspect_raster_path, raster_datetime, i
 
 
 def calc_azimuth_array(lat_array, lon_array, raster_datetime):
-    def calc_azimuth_for_datetime(lat, lon):
-        return solar.get_azimuth_fast(lat, lon, raster_datetime).astype(np.dtype('float32'))
-    return np.array(list(map(calc_azimuth_for_datetime, lat_array, lon_array)))
+    # The pysolar _fast functions are written with numpy ufuncs, so the whole array goes in one call
+    # rather than one call per row
+    return np.asarray(solar.get_azimuth_fast(np.asarray(lat_array), np.asarray(lon_array), raster_datetime),
+                      dtype=np.float32)
 
 
 def calc_altitude_array(lat_array, lon_array, raster_datetime):
-    def calc_altitude_for_datetime(lat, lon):
-        return solar.get_altitude_fast(lat, lon, raster_datetime).astype(np.dtype('float32'))
-    return np.array(list(map(calc_altitude_for_datetime, lat_array, lon_array)))
+    return np.asarray(solar.get_altitude_fast(np.asarray(lat_array), np.asarray(lon_array), raster_datetime),
+                      dtype=np.float32)
 
 
 def ic_calculation(lat_array, lon_array, aspect_array, slope_array, raster_datetime):
-    print("Precomputing azimuth, altitude and and zenith arrays")
+    log.info("Precomputing azimuth, altitude and and zenith arrays")
     azimuth_array = calc_azimuth_array(lat_array, lon_array, raster_datetime)
     altitude_array = calc_altitude_array(lat_array, lon_array, raster_datetime)
     zenith_array = 90-altitude_array
-    print("Beginning IC calculation.")
+    log.info("Beginning IC calculation.")
     ic_array = _deg_cos(zenith_array) * _deg_cos(slope_array) + \
                _deg_sin(zenith_array) * _deg_sin(slope_array) * _deg_cos(azimuth_array - aspect_array)
     return ic_array, zenith_array
@@ -242,7 +239,7 @@ def do_terrain_correction(raster_path, dem_path, out_raster_path, raster_datetim
         DEBUG_PROJECTION = in_raster.GetProjection()
         DEBUG_GT = in_raster.GetGeoTransform()
 
-        print("Preprocessing DEM")
+        log.info("Preprocessing DEM")
         # If we resample then extract slope and angle, then they have Weird Holes in them that correspond to the centre
         # of pixels. So we need to extract then preprocess -_-
         slope_raster_path, angle_raster_path = generate_slope_and_aspect_rasters(dem_path, td)
@@ -258,25 +255,30 @@ def do_terrain_correction(raster_path, dem_path, out_raster_path, raster_datetim
             in_array = np.expand_dims(in_array, 0)
 
         if is_landsat:
-            print("Calculating reflectance array")
+            log.info("Calculating reflectance array")
             # Oh no, magic numbers. I think these were from the original paper? Are they for Landsat?
         #ref_multi_this_band = 2.0e-5
         #ref_add_this_band = -0.1
         #ref_array = (ref_multi_this_band * in_array + ref_add_this_band) / _deg_cos(zenith_array.T)
         else:
-            print("Meatball reflectance test")
+            log.debug("Meatball reflectance test")
             ref_array = np.divide(in_array,10000, dtype=np.half)   # This number straight from Sahid.
             #ref_array = in_array
 
-        print("Calculating sample array")
+        log.info("Calculating sample array")
         sample_array = build_sample_array(ref_array, slope_array, red_band_index=2, ir_band_index=3)
         ras.save_array_as_image(sample_array.astype(np.short), 'sample_array.tif', DEBUG_GT, DEBUG_PROJECTION)
         band_indicies = sample_array[0, ...].nonzero()
 
-        print("Beginning linear regression")
+        log.info("Beginning linear regression")
+        # The IC samples and the IC - cos(zenith) term are the same for every band, so they are worked out once here
+        # rather than once per band
+        ic_for_linregress = ic_array[band_indicies[0], band_indicies[1]].ravel()
+        ic_offset_array = ic_array - _deg_cos(zenith_array)
         for i, band in enumerate(sample_array[:, ...]):
-            print("Processing band {} of {}".format(i+1, ref_array.shape[0]))
-            out_array[i, ...] = correct_reflectance(band, band_indicies, i, ic_array, ref_array, zenith_array)
+            log.info("Processing band {} of {}".format(i+1, ref_array.shape[0]))
+            out_array[i, ...] = correct_reflectance(band, band_indicies, i, ic_array, ref_array, zenith_array,
+                                                    ic_for_linregress, ic_offset_array)
 
     out_array = None
     out_raster = None
@@ -296,12 +298,16 @@ def preprocess_dem(dem_path, raster_path, out_directory):
     return clipped_dem_path
 
 
-def correct_reflectance(band, band_indicies, i, ic_array, ref_array, zenith_array):
+def correct_reflectance(band, band_indicies, i, ic_array, ref_array, zenith_array, ic_for_linregress=None,
+                        ic_offset_array=None):
     import joblib
-    ic_for_linregress = ic_array[band_indicies[0], band_indicies[1]].ravel()
+    if ic_for_linregress is None:
+        ic_for_linregress = ic_array[band_indicies[0], band_indicies[1]].ravel()
+    if ic_offset_array is None:
+        ic_offset_array = ic_array - _deg_cos(zenith_array)
     band_for_linregress = band[band_indicies[0], band_indicies[1]].ravel()
     slope, _, _, _, _ = stats.linregress(ic_for_linregress, band_for_linregress)
-    corrected_band = (band - (slope * (ic_array - _deg_cos(zenith_array))))
+    corrected_band = (band - (slope * ic_offset_array))
     joblib.dump(ic_for_linregress, f"{i}_ic")
     joblib.dump(band_for_linregress, f"{i}_band")
     return np.where(band > 0, corrected_band, ref_array[i, ...])
@@ -32,3 +32,16 @@ def test_raster_reclass_binary():
     out_filename = 'test_outputs/class_composite_T36NYF_20180112T075259_20180117T075241_rcl.tif'
     a = pyeo.classification.raster_reclass_binary(test_image_name, test_value, outFn=out_filename)
     assert np.all(np.unique(a) == [0, 1])
+
+
+@pytest.mark.slow
+def test_classify_image_restores_model_n_jobs():
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    model = pyeo.classification._load_model("test_data/manantlan_v1.pkl",
+                                            os.path.getmtime("test_data/manantlan_v1.pkl"))
+    model.n_jobs = 3
+    pyeo.classification.classify_image("test_data/composite_T36MZE_20190509T073621_20190519T073621_clipped.tif",
+                                       model,
+                                       "test_outputs/class_composite_T36MZE_20190509T073621_20190519T073621_n_jobs.tif",
+                                       num_chunks=4)
+    assert model.n_jobs == 3
@@ -17,3 +17,61 @@ def test_l2_validation():
     test_wrong = "test_data/S2A_MSIL2A_20170922T025541_N0205_R032_T48MXU_20170922T031550.SAFE"
     assert pyeo.filesystem_utilities.check_for_invalid_l2_data(test_wrong) == 0
 
+
+def test_sort_by_timestamp():
+    test_names = ["S2B_MSIL2A_20180713T172709_N0206_R012_T13QFB_20180713T192359.SAFE",
+                  "not_an_image.tif",
+                  "S2A_MSIL2A_20180329T171921_N0206_R012_T13QFB_20180329T221746.SAFE",
+                  "composite_T13QFB_20180103T172709.tif"]
+    assert pyeo.filesystem_utilities.sort_by_timestamp(test_names) == [
+        "S2B_MSIL2A_20180713T172709_N0206_R012_T13QFB_20180713T192359.SAFE",
+        "S2A_MSIL2A_20180329T171921_N0206_R012_T13QFB_20180329T221746.SAFE",
+        "composite_T13QFB_20180103T172709.tif"]
+    assert pyeo.filesystem_utilities.sort_by_timestamp(test_names, recent_first=False)[0] == \
+        "composite_T13QFB_20180103T172709.tif"
+
+
+def test_clean_aoi(tmp_path):
+    pyeo.filesystem_utilities.create_file_structure(str(tmp_path))
+    timestamps = ["20180103T172709", "20180329T171921", "20180713T172709"]
+    for timestamp in timestamps:
+        os.mkdir(os.path.join(str(tmp_path), "images/L1", "S2A_MSIL1C_{}_N0206_R012_T13QFB.SAFE".format(timestamp)))
+        for ext in (".tif", ".msk"):
+            open(os.path.join(str(tmp_path), "images/stacked", "stack_T13QFB_{}{}".format(timestamp, ext)), "w").close()
+    pyeo.filesystem_utilities.clean_aoi(str(tmp_path), images_to_keep=2)
+    assert sorted(os.listdir(os.path.join(str(tmp_path), "images/L1"))) == [
+        "S2A_MSIL1C_20180329T171921_N0206_R012_T13QFB.SAFE",
+        "S2A_MSIL1C_20180713T172709_N0206_R012_T13QFB.SAFE"]
+    assert sorted(os.listdir(os.path.join(str(tmp_path), "images/stacked"))) == [
+        "stack_T13QFB_20180329T171921.msk", "stack_T13QFB_20180329T171921.tif",
+        "stack_T13QFB_20180713T172709.msk", "stack_T13QFB_20180713T172709.tif"]
+
+
+def test_get_safe_dirs(tmp_path):
+    safe_names = ["S2B_MSIL2A_20180713T172709_N0206_R012_T13QFB_20180713T192359.SAFE",
+                  "S2A_MSIL2A_20180329T171921_N0206_R012_T13QFB_20180329T221746.SAFE"]
+    for safe_name in safe_names:
+        os.mkdir(os.path.join(str(tmp_path), safe_name))
+    os.mkdir(os.path.join(str(tmp_path), "not_a_safe"))
+    open(os.path.join(str(tmp_path), "sen2cor.log"), "w").close()
+    open(os.path.join(str(tmp_path), "S2A_stray_file.SAFE"), "w").close()
+    assert pyeo.filesystem_utilities.get_safe_dirs(str(tmp_path)) == \
+        [os.path.join(str(tmp_path), safe_name) for safe_name in sorted(safe_names)]
+
+
+def test_prefetch_files(tmp_path):
+    test_file = tmp_path / "image.tif"
+    test_file.write_bytes(b"\0" * 4096)
+    pyeo.filesystem_utilities.prefetch_files([str(test_file), str(tmp_path / "missing.tif")])
+    assert test_file.read_bytes() == b"\0" * 4096
+
+
+def test_close_cached_datasets(tmp_path):
+    import gdal
+    import pyeo.raster_manipulation
+    band_path = str(tmp_path / "T13QFB_20180713T172709_B02_10m.tif")
+    gdal.GetDriverByName("GTiff").Create(band_path, 4, 4, 1, gdal.GDT_UInt16)
+    assert pyeo.raster_manipulation._open_read_only(band_path)
+    assert pyeo.raster_manipulation._open_cached.cache_info().currsize > 0
+    pyeo.filesystem_utilities.close_cached_datasets()
+    assert pyeo.raster_manipulation._open_cached.cache_info().currsize == 0
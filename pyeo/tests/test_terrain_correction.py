@@ -4,6 +4,7 @@ from os import path as p
 
 import pyeo.terrain_correction as terrain_correction
 import osgeo.gdal as gdal
+import osgeo.osr as osr
 import pathlib
 import numpy as np
 import pytest
@@ -45,15 +46,25 @@ def test_get_pixel_latlon():
 
 
 def test_calculate_latlon_array():
-    raster_path = "test_data/dem_test_indonesia.tif"
-    raster = gdal.Open(raster_path)
-    array = raster.GetVirtualMemArray()
+    # 3 rows by 5 columns, so a transposed result doesn't line up
+    raster = gdal.GetDriverByName("MEM").Create("", 5, 3, 1, gdal.GDT_Float32)
+    raster.SetGeoTransform((600000, 10, 0, 9400000, 0, -10))
+    projection = osr.SpatialReference()
+    projection.ImportFromEPSG(32748)
+    raster.SetProjection(projection.ExportToWkt())
+    array = raster.GetRasterBand(1).ReadAsArray()
     transformer, gt = terrain_correction._generate_latlon_transformer(raster)
-    lon, lat = terrain_correction._generate_latlon_arrays(array, transformer, gt)
-    test_lat = joblib.load("test_data/lat_array_indo")
-    test_lon = joblib.load("test_data/lon_array_indo")
-    assert np.all(lat == test_lat)
-    assert np.all(lon == test_lon)
+    lat, lon = terrain_correction._generate_latlon_arrays(array, transformer, gt)
+    assert lat.shape == array.shape
+    assert lon.shape == array.shape
+    assert lat.dtype == np.float64
+    for row in range(array.shape[0]):
+        for col in range(array.shape[1]):
+            x_geo = gt[0] + col * gt[1] + row * gt[2]
+            y_geo = gt[3] + col * gt[4] + row * gt[5]
+            target_lon, target_lat, _ = transformer.TransformPoint(x_geo, y_geo)
+            np.testing.assert_allclose(lat[row, col], target_lat)
+            np.testing.assert_allclose(lon[row, col], target_lon)
 
 
 @pytest.mark.skip
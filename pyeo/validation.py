@@ -125,7 +125,13 @@ def count_pixel_classes(map_path, no_data=None):
     """
     map = gdal.Open(map_path)
     map_array = map.GetVirtualMemArray().squeeze()
-    unique, counts = np.unique(map_array, return_counts=True)
+    if map_array.dtype in (np.uint8, np.uint16):
+        # Class maps are usually 8 or 16 bit; bincount tallies those in one pass, where unique would sort the map
+        all_counts = np.bincount(map_array.ravel(), minlength=1)
+        unique = np.flatnonzero(all_counts)
+        counts = all_counts[unique]
+    else:
+        unique, counts = np.unique(map_array, return_counts=True)
     out = dict(zip([int(val) for val in unique], counts))
     if no_data is not None:
       out.pop(no_data, "_")   # pop the no data value, but don't worry if there's nothing there.
@@ -340,6 +346,7 @@ def cal_total_sample_size(desired_standard_error, user_accuracy, total_class_siz
     -------
     The total number of sample points to achieve the specified error
     """
+    log = logging.getLogger(__name__)
     total_pixel = (sum(total_class_sizes.values()))
     if type == 'simple':
         weighted_U_sum = 0
@@ -362,7 +369,7 @@ def cal_total_sample_size(desired_standard_error, user_accuracy, total_class_siz
         bottom_right = (1 / total_pixel) * weighted_U_sum
 
         n = (up / (desired_standard_error ** 2 + bottom_right))
-    print('suggested total sample size are:' + str(n))
+    log.info('suggested total sample size are:' + str(n))
     return int(np.round(n))
 
 